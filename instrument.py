@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+# Phase timings and counters shared by the admin scripts, linked into each script directory.
+# Scripts wrap their phases in span(), count what they handle with count() and run commands through call(),
+# which times them as subprocess.<program> spans. export() writes everything once the run is over, as a
+# JSON line appended to a log, or as a Prometheus textfile collector file if the path ends in .prom.
+
+import os, time, json, _thread
+
+PROMETHEUS_PREFIX = 'admin_script'
+
+# The low level lock keeps threading out of the import time of cron scripts
+_lock = _thread.allocate_lock()
+_started = time.time()
+_spans = {}         # name: [calls, seconds]
+_counters = {}      # name: value
+
+class span(object):
+    "Context manager timing a phase, concurrent spans of the same name add up"
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        elapsed = time.perf_counter() - self.start
+        with _lock:
+            timing = _spans.setdefault(self.name, [0, 0.0])
+            timing[0] += 1
+            timing[1] += elapsed
+
+def count(name, value = 1):
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+def call(command, check = False, **kwargs):
+    "subprocess.run() timed as a subprocess.<program> span, returns the exit status"
+    import subprocess
+    with span('subprocess.' + os.path.basename(command[0])):
+        return subprocess.run(command, check=check, **kwargs).returncode
+
+def snapshot(job):
+    with _lock:
+        return {
+                'job': job,
+                'time': round(_started, 3),
+                'duration': round(time.time() - _started, 6),
+                'spans': {name: {'calls': calls, 'seconds': round(seconds, 6)}
+                    for (name, (calls, seconds)) in sorted(_spans.items())},
+                'counters': dict(sorted(_counters.items())),
+                }
+
+def format_prometheus(metrics):
+    def sample(name, value, **labels):
+        labels = ','.join('{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                for (key, value) in sorted(dict(labels, job=metrics['job']).items()))
+        return '{}_{}{{{}}} {}'.format(PROMETHEUS_PREFIX, name, labels, value)
+
+    lines = [
+            '# HELP {}_last_run_timestamp_seconds Start time of the last run'.format(PROMETHEUS_PREFIX),
+            '# TYPE {}_last_run_timestamp_seconds gauge'.format(PROMETHEUS_PREFIX),
+            sample('last_run_timestamp_seconds', metrics['time']),
+            '# HELP {}_duration_seconds Wall time of the last run'.format(PROMETHEUS_PREFIX),
+            '# TYPE {}_duration_seconds gauge'.format(PROMETHEUS_PREFIX),
+            sample('duration_seconds', metrics['duration']),
+            '# HELP {}_span_seconds Time spent in each phase during the last run'.format(PROMETHEUS_PREFIX),
+            '# TYPE {}_span_seconds gauge'.format(PROMETHEUS_PREFIX),
+            ]
+    lines.extend(sample('span_seconds', timing['seconds'], span=name) for (name, timing) in metrics['spans'].items())
+    lines.extend([
+            '# HELP {}_span_calls Number of times each phase ran during the last run'.format(PROMETHEUS_PREFIX),
+            '# TYPE {}_span_calls gauge'.format(PROMETHEUS_PREFIX),
+            ])
+    lines.extend(sample('span_calls', timing['calls'], span=name) for (name, timing) in metrics['spans'].items())
+    lines.extend([
+            '# HELP {}_items Items handled during the last run'.format(PROMETHEUS_PREFIX),
+            '# TYPE {}_items gauge'.format(PROMETHEUS_PREFIX),
+            ])
+    lines.extend(sample('items', value, counter=name) for (name, value) in metrics['counters'].items())
+    return '\n'.join(lines) + '\n'
+
+def export(path, job):
+    "Writes the metrics of this run, see the top of this file for formats"
+    metrics = snapshot(job)
+    if path.endswith('.prom'):
+        # node_exporter may read the file at any time, so it is swapped in whole
+        temp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(temp_path, 'w') as fh:
+            fh.write(format_prometheus(metrics))
+        os.replace(temp_path, path)
+    else:
+        with open(path, 'a') as fh:
+            fh.write(json.dumps(metrics) + '\n')
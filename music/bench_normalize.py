@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+import os, sys, io, struct, random, shutil, tempfile, subprocess, time, resource, argparse, contextlib, pstats
+import multiprocessing
+from mutagen.easyid3 import EasyID3
+from mutagen.oggvorbis import OggVorbis
+from mutagen.mp4 import MP4, MP4FreeForm
+
+import normalize
+
+EXTS = ('.mp3', '.ogg', '.m4a')
+AUDIO_SIZE = 4096
+PHASES = (
+        ('tag read', 'read_song'),
+        ('tag write', 'fix_song'),
+        ('rename', '<built-in method posix.rename>'),
+        )
+
+def ogg_crc(data, table = []):
+    if not table:
+        for i in range(256):
+            r = i << 24
+            for j in range(8):
+                r = ((r << 1) ^ 0x04c11db7) if r & 0x80000000 else r << 1
+            table.append(r & 0xffffffff)
+    crc = 0
+    for byte in data:
+        crc = ((crc << 8) ^ table[((crc >> 24) ^ byte) & 0xff]) & 0xffffffff
+    return crc
+
+def ogg_page(packet, sequence, flags, granule = 0):
+    lacing = [255] * (len(packet) // 255) + [len(packet) % 255]
+    header = b'OggS' + struct.pack('<BBqIIIB', 0, flags, granule, 1, sequence, 0, len(lacing)) + bytes(lacing)
+    crc = ogg_crc(header + packet)
+    return header[:22] + struct.pack('<I', crc) + header[26:] + packet
+
+def ogg_skeleton():
+    "Minimal Ogg Vorbis stream mutagen accepts: identification, empty comment and setup headers, one audio page"
+    ident = b'\x01vorbis' + struct.pack('<IBIiiiBB', 0, 2, 44100, 0, 128000, 0, 0xb8, 1)
+    comment = b'\x03vorbis' + struct.pack('<I', 5) + b'bench' + struct.pack('<I', 0) + b'\x01'
+    setup = b'\x05vorbis' + bytes(32)
+    return (ogg_page(ident, 0, 2) + ogg_page(comment, 1, 0) + ogg_page(setup, 2, 0)
+            + ogg_page(bytes(AUDIO_SIZE), 3, 4, 44100))
+
+def atom(name, payload, full = False):
+    if full:
+        payload = bytes(4) + payload
+    return struct.pack('>I4s', 8 + len(payload), name) + payload
+
+def mp4_skeleton():
+    "Minimal MP4 with a single audio track mutagen accepts, tags are added by mutagen"
+    mvhd = atom(b'mvhd', struct.pack('>IIIIII', 0, 0, 1000, 1000, 0x10000, 0x1000000) + bytes(80), True)
+    mdhd = atom(b'mdhd', struct.pack('>IIIIHH', 0, 0, 44100, 44100, 0, 0), True)
+    hdlr = atom(b'hdlr', bytes(4) + b'soun' + bytes(13), True)
+    stsd = atom(b'stsd', bytes(4), True)
+    trak = atom(b'trak', atom(b'mdia', mdhd + hdlr + atom(b'minf', atom(b'stbl', stsd))))
+    return (atom(b'ftyp', b'M4A \0\0\0\0M4A mp42isom') + atom(b'moov', mvhd + trak)
+            + atom(b'mdat', bytes(AUDIO_SIZE)))
+
+def create_song(path, title, track, disc, quirky):
+    ext = os.path.splitext(path)[1]
+    if ext == '.m4a':
+        with open(path, 'wb') as fh:
+            fh.write(mp4_skeleton())
+        meta = MP4(path)
+        meta['\xa9nam'] = [title]
+        meta['trkn'] = [(track, 12)]
+        if disc:
+            meta['disk'] = [(disc, 2)]
+        if quirky:
+            meta['----:com.apple.iTunes:iTunNORM'] = [MP4FreeForm(b' 00000A2B 00000B3C')]
+            meta['----:com.apple.iTunes:iTunSMPB'] = [MP4FreeForm(b' 00000000 00000210')]
+        meta.save()
+        return
+
+    if ext == '.ogg':
+        with open(path, 'wb') as fh:
+            fh.write(ogg_skeleton())
+        meta = OggVorbis(path)
+    else:
+        with open(path, 'wb') as fh:
+            fh.write(b'\xff\xfb\x90\x00' + bytes(AUDIO_SIZE))
+        meta = EasyID3()
+    meta['title'] = title
+    meta['tracknumber'] = '{}/12'.format(track) if quirky else str(track)
+    if disc:
+        meta['discnumber'] = '{}{}'.format(disc, disc) if quirky else str(disc)
+    if ext == '.ogg':
+        meta.save()
+    else:
+        meta.save(path)
+
+def generate_library(root, depth, fanout, files, quirk_rate, seed = 0):
+    "Creates fanout ** depth album directories of files songs each, returns the number of songs"
+    rng = random.Random(seed)
+    count = 0
+    albums = ['']
+    for level in range(depth):
+        albums = [os.path.join(album, 'Dïr {} {}'.format(level, i)) for album in albums for i in range(fanout)]
+    for album in albums:
+        path = os.path.join(root, album)
+        os.makedirs(path, exist_ok=True)
+        disc = rng.choice((None, 1, 2))
+        for track in range(1, files + 1):
+            ext = EXTS[count % len(EXTS)]
+            filename = os.path.join(path, 'track{:05d}{}'.format(count, ext))
+            create_song(filename, 'Song: {}  #{}'.format(track, count), track, disc, rng.random() < quirk_rate)
+            count += 1
+    return count
+
+def read_proc_io():
+    "Syscall and byte counters of the current process (Linux only)"
+    counters = {}
+    try:
+        with open('/proc/self/io') as fh:
+            for line in fh:
+                (key, value) = line.split(':')
+                counters[key] = int(value)
+    except OSError:
+        pass
+    return counters
+
+def phase_timings(stats):
+    timings = {}
+    for (phase, function) in PHASES:
+        timings[phase] = sum(ct for ((filename, line, name), (cc, nc, tt, ct, callers)) in stats.stats.items()
+                if name == function)
+    return timings
+
+def run_pass(root, jobs, full, profiler, queue):
+    "Runs the normalizer once in a dedicated process, so that peak RSS and counters are its own"
+    before = read_proc_io()
+    start = time.perf_counter()
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        if profiler == 'cprofile':
+            import cProfile
+            profile = cProfile.Profile()
+            profile.runcall(normalize.rename_songs, root, jobs, full)
+        elif profiler == 'pyinstrument':
+            from pyinstrument import Profiler
+            profile = Profiler()
+            profile.start()
+            normalize.rename_songs(root, jobs, full)
+            profile.stop()
+        else:
+            normalize.rename_songs(root, jobs, full)
+    elapsed = time.perf_counter() - start
+    after = read_proc_io()
+
+    result = {
+            'elapsed': elapsed,
+            'syscalls': after.get('syscr', 0) + after.get('syscw', 0) - before.get('syscr', 0) - before.get('syscw', 0),
+            'bytes_read': after.get('rchar', 0) - before.get('rchar', 0),
+            'peak_rss': max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss),
+            }
+    if profiler == 'cprofile':
+        output = io.StringIO()
+        stats = pstats.Stats(profile, stream=output)
+        result['phases'] = phase_timings(stats)
+        stats.sort_stats('cumulative').print_stats(30)
+        result['profile'] = output.getvalue()
+    elif profiler == 'pyinstrument':
+        result['profile'] = profile.output_text(unicode=True)
+    queue.put(result)
+
+def strace_pass(root, jobs, full):
+    """Runs normalize.py under strace -c, returns its calls per syscall.
+    Unlike /proc/self/io, this covers every syscall of every process, interpreter startup included."""
+    with tempfile.NamedTemporaryFile('r', prefix='bench_normalize.', suffix='.strace') as output:
+        command = ['strace', '-f', '-c', '-o', output.name, sys.executable, os.path.abspath(normalize.__file__),
+                root, '-j', str(jobs)]
+        if full:
+            command.append('-f')
+        subprocess.run(command, stdout=subprocess.DEVNULL, check=True)
+        calls = {}
+        for line in output:
+            fields = line.split()
+            # % time, seconds, usecs/call, calls, errors (may be empty), syscall
+            if len(fields) in (5, 6) and fields[3].isdigit():
+                calls[fields[-1]] = int(fields[3])
+        return calls
+
+def report_strace(label, calls):
+    print('{}: {} syscalls, {} stat, {} rename, {} read/write'.format(label, calls.get('total', 0),
+        sum(count for (name, count) in calls.items() if 'stat' in name),
+        sum(count for (name, count) in calls.items() if name.startswith('rename')),
+        sum(count for (name, count) in calls.items() if name in ('read', 'write', 'pread64', 'pwrite64'))))
+
+def measure(root, jobs, full, profiler):
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=run_pass, args=(root, jobs, full, profiler, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+def report(label, songs, result, profile_output):
+    print('{}: {} songs in {:.3f}s, {:.1f} songs/s, {} read/write syscalls, {} bytes read, peak RSS {} KiB'.format(
+        label, songs, result['elapsed'], songs / result['elapsed'], result['syscalls'], result['bytes_read'],
+        result['peak_rss']))
+    for (phase, timing) in result.get('phases', {}).items():
+        print('    {}: {:.3f}s'.format(phase, timing))
+    if 'profile' in result:
+        if profile_output:
+            with open(profile_output, 'a') as fh:
+                print(label, file=fh)
+                print(result['profile'], file=fh)
+        else:
+            print(result['profile'])
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark normalize.py on a synthetic library. '
+            'Read/write syscalls and bytes read come from /proc/self/io and only cover worker processes with --jobs 1, '
+            'use --strace to count every syscall.')
+    parser.add_argument('-d', '--depth', type=int, default=2, help='directory depth (default: 2)')
+    parser.add_argument('-w', '--fanout', type=int, default=5, help='subdirectories per directory (default: 5)')
+    parser.add_argument('-f', '--files', type=int, default=12, help='songs per album directory (default: 12)')
+    parser.add_argument('-q', '--quirk-rate', type=float, default=0.5,
+            help='share of songs with "3/12" track numbers, multi-char disc numbers or iTunNORM atoms (default: 0.5)')
+    parser.add_argument('-r', '--runs', type=int, default=3, help='number of runs (default: 3)')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='normalize.py worker processes (default: 1)')
+    parser.add_argument('-p', '--profile', choices=('cprofile', 'pyinstrument'), default=None,
+            help='profile each run (in-process work only), with per-phase timings for cprofile')
+    parser.add_argument('-o', '--profile-output', default=None, help='append profiler reports to this file')
+    parser.add_argument('-k', '--keep', action='store_true', help='keep the generated library')
+    parser.add_argument('-s', '--strace', action='store_true',
+            help='also count every syscall (stat and rename included) of separate cold and indexed passes with strace -c')
+    args = parser.parse_args()
+    if args.strace and not shutil.which('strace'):
+        parser.error('--strace needs strace')
+
+    workdir = tempfile.mkdtemp(prefix='bench_normalize.')
+    try:
+        template = os.path.join(workdir, 'template')
+        start = time.perf_counter()
+        songs = generate_library(template, args.depth, args.fanout, args.files, args.quirk_rate)
+        print('generated {} songs in {:.3f}s under {}'.format(songs, time.perf_counter() - start, template))
+
+        for run in range(args.runs):
+            library = os.path.join(workdir, 'run{}'.format(run))
+            shutil.copytree(template, library)
+            report('run {} cold'.format(run), songs, measure(library, args.jobs, False, args.profile),
+                    args.profile_output)
+            report('run {} indexed'.format(run), songs, measure(library, args.jobs, False, args.profile),
+                    args.profile_output)
+            shutil.rmtree(library)
+
+            if args.strace:
+                shutil.copytree(template, library)
+                report_strace('run {} cold, strace'.format(run), strace_pass(library, args.jobs, False))
+                report_strace('run {} indexed, strace'.format(run), strace_pass(library, args.jobs, False))
+                shutil.rmtree(library)
+    finally:
+        if not args.keep:
+            shutil.rmtree(workdir)
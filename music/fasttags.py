@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+import os, struct
+
+# Upper bound of bytes read to get the tags of a single file
+MAX_READ = 1 << 20
+
+ID3_FRAMES = {
+        'TIT2': 'title', 'TRCK': 'tracknumber', 'TPOS': 'discnumber',
+        'TT2': 'title', 'TRK': 'tracknumber', 'TPA': 'discnumber',
+        }
+ID3_ENCODINGS = ('latin-1', 'utf-16', 'utf-16-be', 'utf-8')
+MP4_ITEMS = (b'\xa9nam', b'trkn', b'disk', b'----')
+
+class TooLarge(Exception):
+    pass
+
+class TagReader(object):
+    "Unbuffered file reader keeping count of the bytes actually read"
+
+    def __init__(self, path):
+        self.fh = open(path, 'rb', buffering=0)
+        self.bytes_read = 0
+
+    def read(self, size):
+        if self.bytes_read + size > MAX_READ:
+            raise TooLarge()
+        data = self.fh.read(size)
+        self.bytes_read += len(data)
+        return data
+
+    def skip(self, size):
+        self.fh.seek(size, os.SEEK_CUR)
+
+    def close(self):
+        self.fh.close()
+
+def synchsafe(data):
+    return (data[0] << 21) | (data[1] << 14) | (data[2] << 7) | data[3]
+
+def read_id3(reader):
+    header = reader.read(10)
+    if len(header) < 10 or header[:3] != b'ID3':
+        return None
+    (major, flags) = (header[3], header[5])
+    # Unsynchronised tags have to be decoded as a whole, leave them to mutagen
+    if major not in (2, 3, 4) or flags & 0x80:
+        return None
+    remaining = synchsafe(header[6:10])
+
+    if flags & 0x40 and major == 3:
+        size = struct.unpack('>I', reader.read(4))[0]
+        reader.skip(size)
+        remaining -= size + 4
+    elif flags & 0x40 and major == 4:
+        size = synchsafe(reader.read(4))
+        reader.skip(size - 4)
+        remaining -= size
+
+    tags = {}
+    header_size = 6 if major == 2 else 10
+    while remaining >= header_size:
+        frame = reader.read(header_size)
+        remaining -= header_size
+        if major == 2:
+            (frame_id, size) = (frame[:3], int.from_bytes(frame[3:6], 'big'))
+        elif major == 3:
+            (frame_id, size) = (frame[:4], struct.unpack('>I', frame[4:8])[0])
+        else:
+            (frame_id, size) = (frame[:4], synchsafe(frame[4:8]))
+        if not frame_id.strip(b'\x00'):
+            break   # padding
+        remaining -= size
+
+        key = ID3_FRAMES.get(frame_id.decode('latin-1'))
+        if key is None:
+            reader.skip(size)
+            continue
+        # Compressed, encrypted, grouped or unsynchronised frame
+        if (major == 3 and frame[9] & 0xe0) or (major == 4 and frame[9] & 0x4f):
+            return None
+        body = reader.read(size)
+        if not body or body[0] >= len(ID3_ENCODINGS):
+            continue
+        text = body[1:].decode(ID3_ENCODINGS[body[0]], errors='replace').rstrip('\x00')
+        tags[key] = [value.lstrip('\ufeff') for value in text.split('\x00')]
+    return tags
+
+def read_ogg_packets(reader, count):
+    "Returns the first count packets of the first logical Ogg stream"
+    packets = []
+    current = b''
+    serial = None
+    while len(packets) < count:
+        header = reader.read(27)
+        if len(header) < 27 or header[:4] != b'OggS':
+            return None
+        segments = reader.read(header[26])
+        size = sum(segments)
+        if serial is not None and header[14:18] != serial:
+            reader.skip(size)
+            continue
+        serial = header[14:18]
+        data = reader.read(size)
+        offset = 0
+        for lacing in segments:
+            current += data[offset:offset + lacing]
+            offset += lacing
+            if lacing < 255:
+                packets.append(current)
+                current = b''
+    return packets
+
+def read_vorbis(reader):
+    packets = read_ogg_packets(reader, 2)
+    if packets is None or not packets[0].startswith(b'\x01vorbis') or not packets[1].startswith(b'\x03vorbis'):
+        return None
+    comment = packets[1]
+    offset = 7
+    vendor_length = struct.unpack_from('<I', comment, offset)[0]
+    offset += 4 + vendor_length
+    count = struct.unpack_from('<I', comment, offset)[0]
+    offset += 4
+
+    tags = {}
+    for i in range(count):
+        length = struct.unpack_from('<I', comment, offset)[0]
+        offset += 4
+        entry = comment[offset:offset + length].decode('utf-8', errors='replace')
+        offset += length
+        if '=' in entry:
+            (key, value) = entry.split('=', 1)
+            tags.setdefault(key.lower(), []).append(value)
+    return tags
+
+def read_atoms(reader, end = None):
+    "Yields (type, payload size) of the sibling atoms at the current position, payload to be read or skipped by the caller"
+    position = 0
+    while end is None or position + 8 <= end:
+        header = reader.read(8)
+        if len(header) < 8:
+            return
+        (size, atom) = struct.unpack('>I4s', header)
+        header_size = 8
+        if size == 1:
+            size = struct.unpack('>Q', reader.read(8))[0]
+            header_size = 16
+        elif size == 0:
+            if end is None:
+                return
+            size = end - position
+        if size < header_size:
+            return
+        position += size
+        yield (atom, size - header_size)
+
+def find_atom(reader, path, end = None):
+    "Seeks into the payload of the atom at path, returns its size"
+    for (atom, size) in read_atoms(reader, end):
+        if atom == path[0]:
+            if atom == b'meta':
+                reader.read(4)  # version and flags
+                size -= 4
+            if len(path) == 1:
+                return size
+            return find_atom(reader, path[1:], size)
+        reader.skip(size)
+    return None
+
+def read_mp4(reader):
+    end = find_atom(reader, (b'moov', b'udta', b'meta', b'ilst'))
+    if end is None:
+        return None
+
+    tags = {}
+    for (item, size) in read_atoms(reader, end):
+        if item not in MP4_ITEMS:
+            reader.skip(size)
+            continue
+        body = reader.read(size)
+        children = {}
+        offset = 0
+        while offset + 8 <= len(body):
+            (child_size, child) = struct.unpack_from('>I4s', body, offset)
+            if child_size < 8:
+                break
+            children.setdefault(child, body[offset + 8:offset + child_size])
+            offset += child_size
+        if b'data' not in children:
+            continue
+        data = children[b'data'][8:]
+
+        if item == b'----':
+            key = '----:{}:{}'.format(children.get(b'mean', b'')[4:].decode('utf-8', errors='replace'),
+                    children.get(b'name', b'')[4:].decode('utf-8', errors='replace'))
+            tags[key] = [data]
+        elif item == b'trkn' and len(data) >= 6:
+            tags['trkn'] = [struct.unpack_from('>HH', data, 2)]
+        elif item == b'disk' and len(data) >= 6:
+            tags['disk'] = [struct.unpack_from('>HH', data, 2)]
+        elif item == b'\xa9nam':
+            tags['\xa9nam'] = [data.decode('utf-8', errors='replace')]
+    return tags
+
+def read_tags(path):
+    """Reads the tags of a song from its header only, the way mutagen exposes them.
+    Returns the tags and the number of bytes read, tags being None when the file needs a full parse."""
+    ext = os.path.splitext(path)[1].lower()
+    reader = TagReader(path)
+    try:
+        if ext == '.ogg':
+            tags = read_vorbis(reader)
+        elif ext == '.mp3':
+            tags = read_id3(reader)
+        else:
+            tags = read_mp4(reader)
+    except (TooLarge, struct.error, IndexError):
+        tags = None
+    finally:
+        reader.close()
+    return (tags, reader.bytes_read)
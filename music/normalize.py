@@ -1,101 +1,298 @@
 #!/usr/bin/env python3
 # -*- coding: UTF-8 -*-
 
-import os, re
+import os, re, argparse, sqlite3, json
+from concurrent.futures import ProcessPoolExecutor
 from unicodedata import normalize
+from urllib.parse import quote
 from mutagen.easyid3 import EasyID3
 from mutagen.oggvorbis import OggVorbis
 from mutagen.mp4 import MP4
 
+from fasttags import read_tags
+import instrument
+
 FORMAT_SINGLE = '{0:02} {1}{2}'
 FORMAT_MULTI = '{0}-{1:02} {2}{3}'
 FORMAT_NOTRACK = '{0}{1}'
 FORBIDDEN_CHARS = dict.fromkeys(map(ord, '/\\?%:*"!|><+\x00'), None)
 #FORBIDDEN_CHARS = '/\\?%:*"!|><+\x00'
 STRIPSPACES = re.compile(r'\s{2,}')
+SONG_EXTS = ('.ogg', '.mp3', '.mp4', '.m4a')
+ITUNES_ATOMS = ('----:com.apple.iTunes:iTunNORM', '----:com.apple.iTunes:iTunSMPB')
+CHUNK_SIZE = 64
+INDEX_FILE = '.normalize.db'
+
+def is_song(filename):
+    return os.path.splitext(filename)[1].lower() in SONG_EXTS
+
+def clean_filename(filename):
+    filename = filename.translate(FORBIDDEN_CHARS)
+    return STRIPSPACES.sub(' ', filename)
+
+def first_tag(meta, key):
+    if key in meta:
+        return str(meta[key][0])
+    return None
+
+def open_song(path):
+    ext = os.path.splitext(path)[1].lower()
+    if ext == '.ogg':
+        return OggVorbis(path)
+    elif ext == '.mp3':
+        return EasyID3(path)
+    return MP4(path)
+
+def read_song(path):
+    """Reads tags of a song, returns its normalized filename, the tag fixes it needs with their messages,
+    its fixed tags and the bytes read to get them (None if the file was fully parsed)"""
+    (sn, ext) = os.path.splitext(path)
+    (meta, bytes_read) = read_tags(path)
+    if meta is None:
+        (meta, bytes_read) = (open_song(path), None)
+    fixes = {}
+    messages = []
+
+    if ext.lower() in ('.mp4', '.m4a'):
+        for atom in ITUNES_ATOMS:
+            if atom in meta:
+                fixes[atom] = None
+
+        if 'disk' in meta:
+            newfilename = (FORMAT_MULTI.format(meta['disk'][0][0],
+                meta['trkn'][0][0], meta['\xa9nam'][0], ext))
+        else:
+            newfilename = (FORMAT_SINGLE.format(meta['trkn'][0][0],
+                meta['\xa9nam'][0], ext))
+        tags = (first_tag(meta, '\xa9nam'), str(meta['trkn'][0][0]),
+                str(meta['disk'][0][0]) if 'disk' in meta else None)
+        return (clean_filename(newfilename), fixes, messages, tags, bytes_read)
+
+    discnumber = first_tag(meta, 'discnumber')
+    tracknumber = first_tag(meta, 'tracknumber')
+    if discnumber is not None and len(discnumber) > 1:
+        fixes['discnumber'] = discnumber[0]
+        messages.append('{0} shortened to {1}'.format(discnumber, discnumber[0]))
+        discnumber = discnumber[0]
+    if tracknumber is not None and not tracknumber.find('/') == -1:
+        newtn = tracknumber[:tracknumber.find('/')]
+        fixes['tracknumber'] = newtn
+        messages.append('{0} shortened to {1}'.format(tracknumber, newtn))
+        tracknumber = newtn
+
+    tags = (first_tag(meta, 'title'), tracknumber, discnumber)
+    if discnumber is not None:
+        newfilename = (FORMAT_MULTI.format(int(discnumber),
+                int(tracknumber), meta['title'][0], ext.lower()))
+    elif tracknumber is not None:
+        newfilename = (FORMAT_SINGLE.format(int(tracknumber),
+                meta['title'][0], ext.lower()))
+    else:
+        try:
+            newfilename = (FORMAT_NOTRACK.format(meta['title'][0], ext.lower()))
+        except KeyError:
+            return (None, fixes, messages, tags, bytes_read)
+    return (clean_filename(newfilename), fixes, messages, tags, bytes_read)
+
+def fix_song(path, fixes):
+    meta = open_song(path)
+    for (key, value) in fixes.items():
+        if value is None:
+            if key in meta:
+                del meta[key]
+        else:
+            meta[key] = value
+    meta.save()
+
+def pool_map(func, jobs, *iterables):
+    if jobs > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            return list(pool.map(func, *iterables, chunksize=CHUNK_SIZE))
+    return list(map(func, *iterables))
 
-def rename_songs():
-    files = os.listdir('.')
-    files.sort()
-    for filename in files:
-        (sn, ext) = os.path.splitext(filename)
-        dirty = False
-
-        if ext.lower() == '.ogg':
-            meta = OggVorbis(filename)
-        elif ext.lower() == '.mp3':
-            meta = EasyID3(filename)
-        elif ext.lower() in ('.mp4', '.m4a'):
-            meta = MP4(filename)
-
-            if '----:com.apple.iTunes:iTunNORM' in meta:
-                del meta['----:com.apple.iTunes:iTunNORM']
-                dirty = True
-            if '----:com.apple.iTunes:iTunSMPB' in meta:
-                del meta['----:com.apple.iTunes:iTunSMPB']
-                dirty = True
-
-            if dirty:
-                meta.save()
-
-            if 'disk' in meta:
-                newfilename = (FORMAT_MULTI.format(meta['disk'][0][0],
-                    meta['trkn'][0][0], meta['\xa9nam'][0], ext))
-            else:
-                newfilename = (FORMAT_SINGLE.format(meta['trkn'][0][0],
-                    meta['\xa9nam'][0], ext))
-            newfilename = newfilename.translate(None, FORBIDDEN_CHARS)
-            newfilename = STRIPSPACES.sub(' ', newfilename)
-            
-            if not os.path.exists(newfilename):
-                print('{0} -> {1}'.format(filename, newfilename))
-                os.rename(filename, newfilename)
+def fingerprint(st):
+    return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+def load_index(root, create = True):
+    "Returns the songs recorded by the last run, keyed by path relative to root; only opened read-only unless create"
+    index_path = os.path.join(root, INDEX_FILE)
+    if not create and not os.path.exists(index_path):
+        return {}
+    uri = 'file:{}{}'.format(quote(index_path), '' if create else '?mode=ro')
+    with sqlite3.connect(uri, uri=True) as conn:
+        if create:
+            conn.execute('CREATE TABLE IF NOT EXISTS songs (path TEXT PRIMARY KEY, inode INTEGER, size INTEGER, '
+                    'mtime INTEGER, title TEXT, tracknumber TEXT, discnumber TEXT, target TEXT)')
+        cur = conn.execute('SELECT path, inode, size, mtime, title, tracknumber, discnumber, target FROM songs')
+        return {row[0]: row[1:] for row in cur}
+
+def save_index(root, records):
+    with sqlite3.connect(os.path.join(root, INDEX_FILE)) as conn:
+        conn.execute('DELETE FROM songs')
+        conn.executemany('INSERT INTO songs VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                ((path,) + record for (path, record) in records))
+
+def scan_tree(path, tree, stats):
+    "Records the sorted listing of every directory below path, keyed by absolute path, and the stat of every song"
+    with os.scandir(path) as it:
+        entries = []
+        for entry in it:
+            is_dir = entry.is_dir()
+            if not is_dir and is_song(entry.name):
+                stats[entry.path] = fingerprint(entry.stat())
+            entries.append((entry.name, is_dir))
+    entries.sort()
+    tree[path] = entries
+    for (name, is_dir) in entries:
+        if is_dir:
+            scan_tree(os.path.join(path, name), tree, stats)
+
+def plan_tree(path, tree, stats, songs, unchanged, plan, verbose = False):
+    """Appends the tag fixes and renames needed below path to plan, children first.
+    Returns the index records of the songs left at their target name, and whether their tags are fixed."""
+    names = set(name for (name, is_dir) in tree[path])
+    fixes = []
+    renames = []
+    records = []
+    # Same order as a sequential walk, so that name collisions are resolved identically
+    for (name, is_dir) in tree[path]:
+        src = os.path.join(path, name)
+        if is_dir:
+            subrecords = plan_tree(src, tree, stats, songs, unchanged, plan, verbose)
+            newfilename = normalize('NFC', name)
+        elif src in songs:
+            (newfilename, tagfixes, messages, tags, bytes_read) = songs[src]
+            if verbose:
+                print('{0}: {1} bytes read'.format(name, 'all' if bytes_read is None else bytes_read))
+            if tagfixes:
+                fixes.append([name, tagfixes, messages])
+            if newfilename is None:
+                print('defective file: {0}'.format(name))
+                continue
+        elif src in unchanged:
+            records.append((name, unchanged[src], False))
             continue
         else:
-            if filename not in ('.', '..') and os.path.isdir(filename):
-                os.chdir(filename)
-                rename_songs()
-                os.chdir('..')
-                uf = filename
-                newfilename = normalize('NFC', uf)
-                if not os.path.exists(newfilename):
-                    print('{0} -> {1}'.format(filename, newfilename))
-                    os.rename(filename, newfilename)
             continue
 
-        if 'discnumber' in meta and len(meta['discnumber'][0]) > 1:
-            olddn = meta['discnumber'][0]
-            newdn = meta['discnumber'][0][0]
-            meta['discnumber'] = newdn
-            print('{0} shortened to {1}'.format(olddn, newdn))
-            dirty = True
-        if 'tracknumber' in meta and not meta['tracknumber'][0].find('/') == -1:
-            oldtn = meta['tracknumber'][0]
-            newtn = meta['tracknumber'][0][:meta['tracknumber'][0].find('/')]
-            meta['tracknumber'] = newtn
-            print('{0} shortened to {1}'.format(oldtn, newtn))
-            dirty = True
-        if dirty:
-            meta.save()
-
-        if 'discnumber' in meta:
-            newfilename = (FORMAT_MULTI.format(int(meta['discnumber'][0]), 
-                    int(meta['tracknumber'][0]), meta['title'][0], ext.lower()))
-        elif 'tracknumber' in meta:
-            newfilename = (FORMAT_SINGLE.format(int(meta['tracknumber'][0]), 
-                    meta['title'][0], ext.lower()))
-        else:
-            try:
-                newfilename = (FORMAT_NOTRACK.format(meta['title'][0], ext.lower()))
-            except KeyError:
-                print('defective file: {0}'.format(filename))
-        #newfilename = newfilename.translate(None, FORBIDDEN_CHARS)
-        newfilename = newfilename.translate(FORBIDDEN_CHARS)
-        newfilename = STRIPSPACES.sub(' ', newfilename)
-        
-        if not os.path.exists(newfilename):
-            print('{0} -> {1}'.format(filename, newfilename))
-            os.rename(filename, newfilename)
+        if newfilename not in names:
+            renames.append([name, newfilename])
+            names.discard(name)
+            names.add(newfilename)
+            name = newfilename
+
+        if is_dir:
+            records.extend((os.path.join(name, subpath), record, dirty) for (subpath, record, dirty) in subrecords)
+        elif name == newfilename:
+            records.append((name, stats[src] + tags + (newfilename,), bool(tagfixes)))
+
+    if fixes or renames:
+        plan.append({'path': path, 'fixes': fixes, 'renames': renames})
+    return records
+
+def apply_plan(plan, jobs = 1, dry_run = False):
+    "Applies every tag fix, then every rename; an interrupted plan can be applied again to resume it"
+    fixes = []
+    for directory in plan:
+        for (name, tagfixes, messages) in directory['fixes']:
+            path = os.path.join(directory['path'], name)
+            # Songs already renamed were fixed by an interrupted run
+            if os.path.exists(path):
+                for message in messages:
+                    print(message)
+                fixes.append((path, tagfixes))
+    if fixes and not dry_run:
+        with instrument.span('fix'):
+            pool_map(fix_song, jobs, *zip(*fixes))
+    instrument.count('fixes', len(fixes))
+
+    with instrument.span('rename'):
+        apply_renames(plan, dry_run)
+
+def apply_renames(plan, dry_run = False):
+    "Renames songs, never overwriting an existing file"
+    for directory in plan:
+        for (name, newfilename) in directory['renames']:
+            src = os.path.join(directory['path'], name)
+            dst = os.path.join(directory['path'], newfilename)
+            src_exists = os.path.lexists(src)
+            dst_exists = os.path.lexists(dst)
+            if not src_exists and dst_exists:
+                # Already renamed by an interrupted run
+                continue
+            if not src_exists:
+                print('{0} is missing, not renamed to {1}'.format(name, newfilename))
+                continue
+            # Renames differing by case only find their own song on case-insensitive filesystems
+            if dst_exists and not os.path.samefile(src, dst):
+                print('{0} already exists, {1} not renamed'.format(newfilename, name))
+                instrument.count('renames_skipped')
+                continue
+            print('{0} -> {1}'.format(name, newfilename))
+            if dry_run:
+                continue
+            os.rename(src, dst)
+            instrument.count('renames')
+
+def rename_songs(root = '.', jobs = 1, full = False, dry_run = False, plan_file = None, verbose = False):
+    root = os.path.abspath(root)
+    tree = {}
+    stats = {}
+    with instrument.span('scan'):
+        scan_tree(root, tree, stats)
+
+        # Songs whose stat did not change since the last run are already normalized,
+        # the index being left alone by runs which don't apply changes
+        index = load_index(root, create=not (dry_run or plan_file))
+        unchanged = {}
+        if not full:
+            for (path, st) in stats.items():
+                record = index.get(os.path.relpath(path, root))
+                if record is not None and record[:3] == st:
+                    unchanged[path] = record
+
+    paths = [path for path in stats if path not in unchanged]
+    with instrument.span('parse'):
+        songs = dict(zip(paths, pool_map(read_song, jobs, paths)))
+    instrument.count('songs', len(stats))
+    instrument.count('songs_parsed', len(songs))
+    plan = []
+    with instrument.span('plan'):
+        records = plan_tree(root, tree, stats, songs, unchanged, plan, verbose)
+    if verbose:
+        bytes_read = [song[4] for song in songs.values() if song[4] is not None]
+        print('{0} songs read from their header ({1} bytes), {2} fully parsed'.format(
+            len(bytes_read), sum(bytes_read), len(songs) - len(bytes_read)))
+
+    if plan_file:
+        with open(plan_file, 'w') as fh:
+            json.dump(plan, fh, indent=2, ensure_ascii=False)
+        return
+    apply_plan(plan, jobs, dry_run)
+    if not dry_run:
+        with instrument.span('index'):
+            save_index(root, [(path, fingerprint(os.stat(os.path.join(root, path))) + record[3:] if dirty else record)
+                    for (path, record, dirty) in records])
 
 if __name__ == '__main__':
-    rename_songs()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('root', nargs='?', default='.', help='music library root (default: current directory)')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+            help='number of worker processes reading and fixing tags (default: 1)')
+    parser.add_argument('-v', '--verbose', action='store_true', help='talk more, including bytes read per song')
+    parser.add_argument('-f', '--full', action='store_true',
+            help='rescan every song, even those unchanged since the last run')
+    parser.add_argument('-n', '--dry-run', action='store_true', help='only display the planned changes')
+    parser.add_argument('-p', '--plan', default=None, help='write the planned changes to a JSON file instead of applying them')
+    parser.add_argument('-a', '--apply', default=None,
+            help='apply (or resume) the changes planned in a JSON file written by --plan')
+    parser.add_argument('-M', '--metrics', default=None,
+            help='append run metrics to this JSON lines file, or write them to a Prometheus textfile if it ends in .prom')
+    args = parser.parse_args()
+    if args.apply:
+        with open(args.apply) as fh:
+            apply_plan(json.load(fh), args.jobs, args.dry_run)
+    else:
+        rename_songs(args.root, args.jobs, args.full, args.dry_run, args.plan, args.verbose)
+    if args.metrics:
+        instrument.export(args.metrics, 'rename_songs')
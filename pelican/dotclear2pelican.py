@@ -1,11 +1,14 @@
 #!/usr/bin/env python3
 # -*- encoding: UTF-8 -*-
 
-import os, sys, unicodedata, re
+import os, sys, unicodedata, re, argparse, time, itertools, collections, hashlib, json, sqlite3, queue, threading
+from concurrent.futures import ThreadPoolExecutor
 import psycopg2
 import psycopg2.extras
 import pypandoc
 
+import instrument
+
 DOTCLEAR_SERVER = '*******'
 DOTCLEAR_USER = '*******'
 DOTCLEAR_DB = '*******'
@@ -13,18 +16,105 @@ DOTCLEAR_PWD = '*******'
 OUTPUT_DIR = '*******'
 INPUT_FORMAT = 'textile'
 OUTPUT_FORMAT = 'rst'
+ITERSIZE = 500
+WORKERS = os.cpu_count()
+BATCH_SIZE = 20
+
+# Posts converted by a single pandoc invocation are separated by this paragraph
+BATCH_SEPARATOR = 'dotclearpostseparator'
+SPLIT_BATCH = re.compile(r'^{}$'.format(BATCH_SEPARATOR), re.MULTILINE)
+# Definitions pandoc gathers at the end of the document (substitutions, footnotes, targets)
+DOCUMENT_DEFINITIONS = re.compile(r'^\.\. [|\[_]', re.MULTILINE)
+# Textile images, footnotes and link aliases, the sources of such definitions
+LIKELY_DEFINITIONS = re.compile(r'(?<![\w!])![^\s!][^!\n]*!|<img\b|\[\d+\]|^fn\d+\.|^\[[^\]\s]+\]\S', re.MULTILINE)
+
+MANIFEST_FILE = '.dotclear2pelican.json'
+CHECKPOINT_FILE = '.dotclear2pelican.checkpoint'
+JOURNAL_FILE = '.dotclear2pelican.journal'
+CHECKPOINT_EVERY = 100  # posts
+QUEUE_SIZE = 1000       # posts waiting between two pipeline stages
+CACHE_FILE = os.path.expanduser('~/.cache/dotclear2pelican.db')
+CACHE_SIZE = 256    # MiB
+
+POSTS_QUERY = ('SELECT post_id, post_dt, post_upddt, post_title, post_excerpt, post_content, post_status, cat_title '
+        'FROM dc_post NATURAL INNER JOIN dc_category {} ORDER BY post_dt, post_id')
+POST_IDS_QUERY = 'SELECT post_id FROM dc_post'
+
+# Fixups of pandoc output as (kind, pattern, replacement), applied in a single pass:
+# 'literal' and 'regex' rules substitute their matches, 'imglink' rules also collect the
+# (tag, url) groups of their match as a link target, the url being fixed up as well.
+# Rules are joined into one alternation, so they can't use backreferences nor share group names
+REWRITE_RULES = [
+    ('imglink', r'\|([^\|]+)\|:((?:\{filename\}/images/|https://media\.lordran\.net/alpha/posts/'
+        r'|https://old-alpha\.lordran\.net/public/)[-_/\\a-zA-Z0-9\.]+)', r'|\1|_'),
+    ('literal', 'https://media.lordran.net/alpha/posts/', '{filename}/images/v1/'),
+    ('literal', 'https://old-alpha.lordran.net/public/', '{filename}/images/v2/'),
+    # Bad smileys
+    ('regex', r' :sup:``[;"]', '.'),
+    # Lines made of non-breaking spaces
+    ('regex', '^  \xa0(?:\n|$)', ''),
+    # Patch Totoro
+    ('literal', ' o\\_o', ''),
+    ]
+
+BACKREFERENCE = re.compile(r'(?<!\\)(?:\\\\)*(?:\\[1-9]|\(\?P=)')
+
+class Rewriter(object):
+    "Compiles rewrite rules into a single pattern, applied to each post in one pass"
 
-V1_MEDIA = re.compile(r'https://media.lordran.net/alpha/posts/(.*)')
-V1_REP = r'{filename}/images/v1/\1'
-V2_MEDIA = re.compile(r'https://old-alpha.lordran.net/public/(.*)')
-V2_REP = r'{filename}/images/v2/\1'
+    def __init__(self, rules = REWRITE_RULES):
+        self.rules = []
+        patterns = []
+        names = {}
+        for (i, rule) in enumerate(rules):
+            if len(rule) != 3:
+                raise ValueError('rewrite rule {}: expected [kind, pattern, replacement]'.format(i))
+            (kind, pattern, replacement) = rule
+            if kind == 'literal':
+                pattern = re.escape(pattern)
+            elif kind not in ('regex', 'imglink'):
+                raise ValueError('rewrite rule {}: unknown kind {}'.format(i, kind))
+            try:
+                compiled = re.compile(pattern, re.MULTILINE)
+            except re.error as e:
+                raise ValueError('rewrite rule {}: {}'.format(i, e))
+            if BACKREFERENCE.search(pattern):
+                raise ValueError('rewrite rule {}: backreferences are not supported'.format(i))
+            if kind == 'imglink' and compiled.groups < 2:
+                raise ValueError('rewrite rule {}: imglink rules need (tag) and (url) groups'.format(i))
+            for name in compiled.groupindex:
+                if name in names or re.fullmatch(r'rule\d+', name):
+                    raise ValueError('rewrite rule {}: group name {} is already used'.format(i, name))
+                names[name] = i
+            # Rules are matched again on their own to expand their groups
+            self.rules.append((kind, compiled, replacement))
+            patterns.append('(?P<rule{}>{})'.format(i, pattern))
+        self.pattern = re.compile('|'.join(patterns), re.MULTILINE)
 
-BAD_SMILEY = re.compile(r' :sup:``[;"]')
-FIX_SMILEY = r'.'
+    def rewrite(self, text):
+        "Returns the fixed up text and the (tag, url) image links found in it"
+        imglinks = []
 
-BAD_NBSP = '   '
+        def replace(match):
+            (kind, rule, replacement) = self.rules[int(match.lastgroup[4:])]
+            if kind == 'literal':
+                return replacement
+            # Matching in the whole string at the same position keeps lookarounds and anchors working
+            rule_match = rule.match(match.string, match.start())
+            if rule_match is None or rule_match.end() != match.end():
+                return match.group()
+            if kind == 'imglink':
+                imglinks.append((rule_match.group(1), self.pattern.sub(replace, rule_match.group(2))))
+            return rule_match.expand(replacement)
 
-BAD_IMGLINK = re.compile(r'\|([^\|]+)\|:(\{filename\}/images/[-_/\\a-zA-Z0-9\.]+)')
+        return (self.pattern.sub(replace, text).strip(), imglinks)
+
+def load_rules(path):
+    "Reads rewrite rules from a JSON list of [kind, pattern, replacement], raises ValueError on invalid rules"
+    with open(path) as fh:
+        rules = [tuple(rule) for rule in json.load(fh)]
+    Rewriter(rules)
+    return rules
 
 def suppression_diacritics(s):
     def remove(char):
@@ -45,66 +135,477 @@ def slugify(value):
     value = re.sub(r'[^\w\s-]', '', value).strip().lower()
     return re.sub(r'[-\s]+', '-', value).strip('-')
 
-with psycopg2.connect(dbname=DOTCLEAR_DB, user=DOTCLEAR_USER, password=DOTCLEAR_PWD, host=DOTCLEAR_SERVER) as conn:
-    with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
-        cur.execute('SELECT post_dt, post_upddt, post_title, post_excerpt, post_content, post_status, cat_title FROM dc_post NATURAL INNER JOIN dc_category ORDER BY post_dt')
-
-        for row in cur.fetchall():
-            filename = '{}_{}.rst'.format(row['post_dt'].isoformat(), slugify(row['post_title']))
-            #cat_slug = slugify(row['cat_title'])
-            cat_slug = row['cat_title']
-
-            # Create category block
-            cat_path = os.path.join(OUTPUT_DIR, cat_slug)
-            if not os.path.exists(cat_path):
-                os.makedirs(cat_path)
-
-            filepath = os.path.join(cat_path, filename)
-            print(filepath)
-            with open(filepath, 'w') as fh:
-                # Title
-                print(row['post_title'], file=fh)
-                print('#' * len(row['post_title']), file=fh)
-                print(file=fh)
-
-                # Date
-                print(':date:', row['post_dt'].isoformat(), file=fh)
-                print(':modified:', row['post_upddt'].isoformat(), file=fh)
-
-                print(':category:', row['cat_title'], file=fh)
-                print(':slug:', slugify(row['post_title']), file=fh)
-                print(':author: Johann', file=fh)
-                print(':lang: fr', file=fh)
-                if row['post_status'] == 1:
-                    print(':status: published', file=fh)
-                else:
-                    print(':status: draft', file=fh)
-                print(file=fh)
-
-                output = pypandoc.convert_text(row['post_excerpt'] + "\n\n" + row['post_content'], \
-                        OUTPUT_FORMAT, format=INPUT_FORMAT)
-
-                output = V1_MEDIA.sub(V1_REP, output)
-                output = V2_MEDIA.sub(V2_REP, output)
-                output = BAD_SMILEY.sub(FIX_SMILEY, output)
-
-                f_output = []
-                for line in output.split('\n'):
-                    if line == BAD_NBSP:
-                        continue
-                    f_output.append(line)
-                output = '\n'.join(f_output).strip()
-
-                # Patch Totoro
-                output = output.replace(' o\_o', '')
-
-                idx_imglinks = []
-                for match in BAD_IMGLINK.finditer(output):
-                    idx_imglinks.append({'tag': match.group(1), 'url': match.group(2)})
-                    output = output.replace('|{}|:{}'.format(match.group(1), match.group(2)),
-                            '|{}|_'.format(match.group(1)))
-
-                print(output, file=fh)
-
-                for imglink in idx_imglinks:
-                    print(".. _{}: {}".format(imglink['tag'], imglink['url']), file=fh)
+def iter_posts(conn, itersize = ITERSIZE, since = None, after = None):
+    """Streams posts through a server-side cursor, fetching itersize rows at a time.
+    Only posts updated after since and coming after the (post_dt, post_id) pair after are streamed, if given."""
+    conditions = []
+    params = []
+    if since is not None:
+        conditions.append('post_upddt > %s')
+        params.append(since)
+    if after is not None:
+        conditions.append('(post_dt, post_id) > (%s, %s)')
+        params.extend(after)
+    where = 'WHERE ' + ' AND '.join(conditions) if conditions else ''
+    with conn.cursor(name='dotclear2pelican', cursor_factory=psycopg2.extras.NamedTupleCursor) as cur:
+        cur.itersize = itersize
+        cur.execute(POSTS_QUERY.format(where), params)
+        for row in cur:
+            yield row
+
+def post_source(row):
+    return row.post_excerpt + "\n\n" + row.post_content
+
+def post_hash(row):
+    fields = (row.post_dt.isoformat(), row.post_upddt.isoformat(), row.post_title, str(row.post_status),
+            row.cat_title, post_source(row))
+    return hashlib.sha256('\0'.join(fields).encode('utf-8')).hexdigest()
+
+def load_manifest(output_dir):
+    """Returns the posts exported by previous runs keyed by post id, and the date of the last complete run.
+    Posts journaled by an interrupted run are included."""
+    try:
+        with open(os.path.join(output_dir, MANIFEST_FILE)) as fh:
+            manifest = json.load(fh)
+    except FileNotFoundError:
+        manifest = {'last_sync': None, 'posts': {}}
+    try:
+        with open(os.path.join(output_dir, JOURNAL_FILE)) as fh:
+            for line in fh:
+                # A line cut short by a crash was not committed
+                if line.endswith('\n'):
+                    (post_id, entry) = json.loads(line)
+                    manifest['posts'][post_id] = entry
+    except FileNotFoundError:
+        pass
+    return manifest
+
+def save_manifest(output_dir, manifest):
+    os.makedirs(output_dir, exist_ok=True)
+    with open(os.path.join(output_dir, MANIFEST_FILE) + '.tmp', 'w') as fh:
+        json.dump(manifest, fh, indent=1, sort_keys=True)
+    os.replace(os.path.join(output_dir, MANIFEST_FILE) + '.tmp', os.path.join(output_dir, MANIFEST_FILE))
+    # The manifest now holds every journaled post
+    try:
+        os.remove(os.path.join(output_dir, JOURNAL_FILE))
+    except FileNotFoundError:
+        pass
+
+def load_checkpoint(output_dir):
+    "Returns the (post_dt, post_id) of the last post committed by an interrupted run, or None"
+    try:
+        with open(os.path.join(output_dir, CHECKPOINT_FILE)) as fh:
+            checkpoint = json.load(fh)
+    except FileNotFoundError:
+        return None
+    return (checkpoint['post_dt'], checkpoint['post_id'])
+
+def save_checkpoint(output_dir, manifest, post_ids, row):
+    """Commits every post exported up to row, included. The manifest entries of post_ids, the posts exported
+    since the previous checkpoint, are appended to a journal rather than rewriting the whole manifest."""
+    with open(os.path.join(output_dir, JOURNAL_FILE), 'a') as fh:
+        fh.write(''.join(json.dumps([post_id, manifest['posts'][post_id]]) + '\n' for post_id in post_ids))
+    with open(os.path.join(output_dir, CHECKPOINT_FILE) + '.tmp', 'w') as fh:
+        json.dump({'post_dt': row.post_dt.isoformat(), 'post_id': row.post_id}, fh)
+    os.replace(os.path.join(output_dir, CHECKPOINT_FILE) + '.tmp', os.path.join(output_dir, CHECKPOINT_FILE))
+
+def clear_checkpoint(output_dir):
+    try:
+        os.remove(os.path.join(output_dir, CHECKPOINT_FILE))
+    except FileNotFoundError:
+        pass
+
+def changed_posts(rows, manifest, output_dir):
+    "Filters out posts whose content is the same as when they were last exported"
+    for row in rows:
+        entry = manifest['posts'].get(str(row.post_id))
+        if entry is None or entry['hash'] != post_hash(row) or \
+                not os.path.exists(os.path.join(output_dir, entry['path'])):
+            yield row
+
+def record_post(manifest, row, filepath, output_dir):
+    "Records an exported post, removing its previous file if it moved"
+    path = os.path.relpath(filepath, output_dir)
+    entry = manifest['posts'].get(str(row.post_id))
+    if entry is not None and entry['path'] != path:
+        remove_export(output_dir, entry['path'])
+    manifest['posts'][str(row.post_id)] = {'upddt': row.post_upddt.isoformat(), 'hash': post_hash(row), 'path': path}
+
+def remove_export(output_dir, path):
+    print('removing', os.path.join(output_dir, path))
+    try:
+        os.remove(os.path.join(output_dir, path))
+    except FileNotFoundError:
+        pass
+
+def remove_deleted_posts(conn, manifest, output_dir):
+    with conn.cursor() as cur:
+        cur.execute(POST_IDS_QUERY)
+        post_ids = set(str(row[0]) for row in cur)
+    for post_id in set(manifest['posts']) - post_ids:
+        remove_export(output_dir, manifest['posts'].pop(post_id)['path'])
+
+def pandoc(text):
+    with instrument.span('subprocess.pandoc'):
+        return pypandoc.convert_text(text, OUTPUT_FORMAT, format=INPUT_FORMAT)
+
+def convert_together(texts):
+    "Converts posts with a single pandoc invocation, splitting the batch in halves if definitions show up"
+    if len(texts) == 1:
+        return [pandoc(texts[0])]
+    separator = '\n\n{}\n\n'.format(BATCH_SEPARATOR)
+    output = pandoc(separator.join(texts))
+    outputs = SPLIT_BATCH.split(output)
+    # Document-level definitions would all land in the last post, halving isolates the posts producing them
+    if len(outputs) == len(texts) and not DOCUMENT_DEFINITIONS.search(output):
+        return outputs
+    middle = len(texts) // 2
+    return convert_together(texts[:middle]) + convert_together(texts[middle:])
+
+def convert_batch(texts):
+    """Converts several posts, returns their outputs in the same order.
+    Posts likely to produce document-level definitions are converted on their own, the others together."""
+    outputs = [None] * len(texts)
+    together = []
+    for (i, text) in enumerate(texts):
+        if LIKELY_DEFINITIONS.search(text):
+            outputs[i] = pandoc(text)
+        else:
+            together.append(i)
+    if together:
+        for (i, output) in zip(together, convert_together([texts[i] for i in together])):
+            outputs[i] = output
+    return outputs
+
+class ConversionCache(object):
+    "On-disk cache of pandoc outputs, keyed by input, formats and pandoc version, evicting least recently used entries"
+
+    def __init__(self, path, max_size = CACHE_SIZE):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Used by the conversion stage, then closed by the main thread once that stage is over
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS conversions (key TEXT PRIMARY KEY, output TEXT, '
+                'size INTEGER, used REAL)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS conversions_used ON conversions (used)')
+        self.max_size = max_size * 1024 * 1024
+        (self.size,) = self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM conversions').fetchone()
+        self.version = pypandoc.get_pandoc_version()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, text):
+        source = '\0'.join((self.version, INPUT_FORMAT, OUTPUT_FORMAT, text))
+        return hashlib.sha256(source.encode('utf-8')).hexdigest()
+
+    def get(self, text):
+        key = self.key(text)
+        row = self.conn.execute('SELECT output FROM conversions WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.conn.execute('UPDATE conversions SET used = ? WHERE key = ?', (time.time(), key))
+        return row[0]
+
+    def put(self, text, output):
+        size = len(output.encode('utf-8'))
+        cursor = self.conn.execute('INSERT OR IGNORE INTO conversions VALUES (?, ?, ?, ?)',
+                (self.key(text), output, size, time.time()))
+        # An existing entry holds the same output and is already counted
+        if cursor.rowcount == 1:
+            self.size += size
+
+    def evict(self):
+        "Removes least recently used entries until the cache is under its maximum size"
+        evicted = []
+        for (key, size) in self.conn.execute('SELECT key, size FROM conversions ORDER BY used'):
+            if self.size <= self.max_size:
+                break
+            evicted.append((key,))
+            self.size -= size
+        self.conn.executemany('DELETE FROM conversions WHERE key = ?', evicted)
+
+    def commit(self):
+        if self.size > self.max_size:
+            self.evict()
+        self.conn.commit()
+
+    def close(self):
+        self.commit()
+        self.conn.close()
+
+def batched(iterable, size):
+    iterator = iter(iterable)
+    batch = list(itertools.islice(iterator, size))
+    while batch:
+        yield batch
+        batch = list(itertools.islice(iterator, size))
+
+def convert_posts(rows, workers = WORKERS, batch_size = BATCH_SIZE, cache = None):
+    "Converts posts concurrently by batches, yields (row, output) in the order of rows"
+    def submit(pool, batch):
+        texts = [post_source(row) for row in batch]
+        outputs = [None] * len(texts)
+        # Each missing text is converted once, even when it recurs in this batch or in batches in flight:
+        # sources are (future, index) of its conversion, the future being None for this batch's own
+        sources = [None] * len(texts)
+        missing = {}
+        for (i, text) in enumerate(texts):
+            if text in in_flight:
+                sources[i] = in_flight[text]
+            elif text in missing:
+                sources[i] = (None, missing[text])
+            else:
+                outputs[i] = cache.get(text) if cache is not None else None
+                if outputs[i] is None:
+                    sources[i] = (None, missing.setdefault(text, len(missing)))
+        future = pool.submit(convert_batch, list(missing)) if missing else None
+        for (text, j) in missing.items():
+            in_flight[text] = (future, j)
+        return (batch, texts, outputs, sources, missing, future)
+
+    def collect(batch, texts, outputs, sources, missing, future):
+        for (i, source) in enumerate(sources):
+            if source is not None:
+                outputs[i] = (source[0] or future).result()[source[1]]
+        if missing:
+            converted = future.result()
+            for (text, j) in missing.items():
+                del in_flight[text]
+                if cache is not None:
+                    cache.put(text, converted[j])
+            if cache is not None:
+                cache.commit()
+        return zip(batch, outputs)
+
+    in_flight = {}
+    pending = collections.deque()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for batch in batched(rows, batch_size):
+            pending.append(submit(pool, batch))
+            # Keep a bounded number of batches in flight
+            if len(pending) > 2 * workers:
+                yield from collect(*pending.popleft())
+        while pending:
+            yield from collect(*pending.popleft())
+
+class Stage(threading.Thread):
+    "Runs an iterable in its own thread, its items are consumed by iterating the stage through a bounded queue"
+
+    DONE = object()
+
+    def __init__(self, name, items, size = QUEUE_SIZE):
+        super().__init__(name=name, daemon=True)
+        self.items = items
+        self.queue = queue.Queue(size)
+        self.stopped = threading.Event()
+        self.error = None
+
+    def run(self):
+        try:
+            for item in self.items:
+                if not self.put(item):
+                    return
+        except Exception as e:
+            self.error = e
+        finally:
+            # Stopped generators wind down (and wait for their pool) right away
+            if hasattr(self.items, 'close'):
+                self.items.close()
+        self.put(self.DONE)
+
+    def put(self, item):
+        "Waits for room in the queue, returns False if the stage was stopped meanwhile"
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def __iter__(self):
+        while True:
+            try:
+                item = self.queue.get(timeout=0.1)
+            except queue.Empty:
+                if self.stopped.is_set():
+                    return
+                continue
+            if item is self.DONE:
+                if self.error is not None:
+                    raise self.error
+                return
+            yield item
+
+    def stop(self):
+        self.stopped.set()
+
+class QueueDepths(object):
+    "Samples the depth of stage queues, each time the writer takes a post"
+
+    def __init__(self, stages):
+        self.stages = stages
+        self.samples = 0
+        self.totals = [0] * len(stages)
+        self.peaks = [0] * len(stages)
+
+    def sample(self):
+        self.samples += 1
+        for (i, stage) in enumerate(self.stages):
+            depth = stage.queue.qsize()
+            self.totals[i] += depth
+            self.peaks[i] = max(self.peaks[i], depth)
+
+    def __str__(self):
+        return ', '.join('{} queue avg {:.1f} max {}'.format(stage.name, total / (self.samples or 1), peak)
+                for (stage, total, peak) in zip(self.stages, self.totals, self.peaks))
+
+def render_post(row, output, rewriter):
+    "Returns the whole reStructuredText file of a post"
+    (output, imglinks) = rewriter.rewrite(output)
+    lines = [
+            # Title
+            row.post_title,
+            '#' * len(row.post_title),
+            '',
+            # Date
+            ':date: ' + row.post_dt.isoformat(),
+            ':modified: ' + row.post_upddt.isoformat(),
+            ':category: ' + row.cat_title,
+            ':slug: ' + slugify(row.post_title),
+            ':author: Johann',
+            ':lang: fr',
+            ':status: published' if row.post_status == 1 else ':status: draft',
+            '',
+            output,
+            ]
+    lines.extend('.. _{}: {}'.format(tag, url) for (tag, url) in imglinks)
+    return '\n'.join(lines) + '\n'
+
+def export_post(row, output, rewriter):
+    filename = '{}_{}.rst'.format(row.post_dt.isoformat(), slugify(row.post_title))
+    #cat_slug = slugify(row.cat_title)
+    cat_slug = row.cat_title
+
+    # Create category block
+    cat_path = os.path.join(OUTPUT_DIR, cat_slug)
+    if not os.path.exists(cat_path):
+        os.makedirs(cat_path)
+
+    filepath = os.path.join(cat_path, filename)
+    print(filepath)
+    content = render_post(row, output, rewriter)
+    with open(filepath, 'w') as fh:
+        fh.write(content)
+    return filepath
+
+def export_posts(rows, manifest, rewriter, workers = WORKERS, batch_size = BATCH_SIZE, cache = None,
+        queue_size = QUEUE_SIZE, checkpoint_every = CHECKPOINT_EVERY, progress = 0):
+    """Runs the fetch -> convert -> write pipeline, fetching and conversion having their own thread.
+    Exported posts and a checkpoint are committed every checkpoint_every posts, and when the pipeline fails.
+    Progress is printed every progress seconds if given. Returns the number of posts written and the queue depths."""
+    fetch = Stage('fetch', rows, queue_size)
+    convert = Stage('convert', convert_posts(fetch, workers, batch_size, cache), queue_size)
+    depths = QueueDepths((fetch, convert))
+    count = 0
+    last = None
+    pending = []
+    start = reported = time.perf_counter()
+    fetch.start()
+    convert.start()
+    try:
+        for (row, output) in convert:
+            depths.sample()
+            with instrument.span('write'):
+                record_post(manifest, row, export_post(row, output, rewriter), OUTPUT_DIR)
+            count += 1
+            last = row
+            pending.append(str(row.post_id))
+            if count % checkpoint_every == 0:
+                save_checkpoint(OUTPUT_DIR, manifest, pending, row)
+                pending = []
+            if progress and time.perf_counter() - reported >= progress:
+                reported = time.perf_counter()
+                print('{} posts, {:.1f} posts/s, {} fetched and {} converted posts waiting'.format(count,
+                    count / (reported - start), fetch.queue.qsize(), convert.queue.qsize()), file=sys.stderr)
+    except BaseException:
+        if last is not None:
+            save_checkpoint(OUTPUT_DIR, manifest, pending, last)
+        raise
+    finally:
+        for stage in (fetch, convert):
+            stage.stop()
+        for stage in (convert, fetch):
+            stage.join()
+    return (count, depths)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-i', '--itersize', type=int, default=ITERSIZE,
+            help='posts fetched per round trip to the database (default: {})'.format(ITERSIZE))
+    parser.add_argument('-w', '--workers', type=int, default=WORKERS,
+            help='concurrent pandoc conversions (default: {})'.format(WORKERS))
+    parser.add_argument('-b', '--batch-size', type=int, default=BATCH_SIZE,
+            help='posts converted per pandoc invocation (default: {})'.format(BATCH_SIZE))
+    parser.add_argument('-I', '--incremental', action='store_true',
+            help='only export posts updated since the last run')
+    parser.add_argument('-c', '--cache', default=CACHE_FILE,
+            help='pandoc conversion cache (default: {})'.format(CACHE_FILE))
+    parser.add_argument('-C', '--cache-size', type=int, default=CACHE_SIZE,
+            help='conversion cache size in MiB (default: {})'.format(CACHE_SIZE))
+    parser.add_argument('-n', '--no-cache', action='store_true', help='always run pandoc')
+    parser.add_argument('-r', '--rules', default=None,
+            help='JSON file of [kind, pattern, replacement] rewrite rules replacing the built-in ones')
+    parser.add_argument('-M', '--metrics', default=None,
+            help='append run metrics to this JSON lines file, or write them to a Prometheus textfile if it ends in .prom')
+    parser.add_argument('-R', '--resume', action='store_true',
+            help='resume an interrupted run after the last post it committed')
+    parser.add_argument('-k', '--checkpoint-every', type=int, default=CHECKPOINT_EVERY,
+            help='posts written between two checkpoints (default: {})'.format(CHECKPOINT_EVERY))
+    parser.add_argument('-q', '--queue-size', type=int, default=QUEUE_SIZE,
+            help='posts waiting between two pipeline stages (default: {})'.format(QUEUE_SIZE))
+    parser.add_argument('-P', '--progress', type=float, default=0, metavar='SECONDS',
+            help='report throughput and queue depths every SECONDS')
+    args = parser.parse_args()
+
+    try:
+        rewriter = Rewriter(load_rules(args.rules)) if args.rules else Rewriter()
+    except ValueError as e:
+        parser.error(str(e))
+
+    manifest = load_manifest(OUTPUT_DIR)
+    since = manifest['last_sync'] if args.incremental else None
+    after = load_checkpoint(OUTPUT_DIR) if args.resume else None
+    if after is not None:
+        print('resuming after post {1} of {0}'.format(*after))
+
+    cache = None if args.no_cache else ConversionCache(args.cache, args.cache_size)
+    start = time.perf_counter()
+    with psycopg2.connect(dbname=DOTCLEAR_DB, user=DOTCLEAR_USER, password=DOTCLEAR_PWD, host=DOTCLEAR_SERVER) as conn:
+        rows = iter_posts(conn, args.itersize, since, after)
+        if args.incremental:
+            rows = changed_posts(rows, manifest, OUTPUT_DIR)
+        try:
+            (count, depths) = export_posts(rows, manifest, rewriter, args.workers, args.batch_size, cache,
+                    args.queue_size, args.checkpoint_every, args.progress)
+            with instrument.span('cleanup'):
+                remove_deleted_posts(conn, manifest, OUTPUT_DIR)
+            # Posts come by date of creation, an interrupted run can't tell which updates it missed
+            if manifest['posts']:
+                manifest['last_sync'] = max(entry['upddt'] for entry in manifest['posts'].values())
+        finally:
+            save_manifest(OUTPUT_DIR, manifest)
+            if cache is not None:
+                cache.close()
+        clear_checkpoint(OUTPUT_DIR)
+    elapsed = time.perf_counter() - start
+    print('{} posts in {:.1f}s, {:.1f} posts/s, {}'.format(count, elapsed, count / elapsed if elapsed else 0, depths))
+    instrument.count('posts', count)
+    if cache is not None:
+        print('conversion cache: {} hits, {} misses'.format(cache.hits, cache.misses))
+        instrument.count('cache_hits', cache.hits)
+        instrument.count('cache_misses', cache.misses)
+    if args.metrics:
+        instrument.export(args.metrics, 'dotclear2pelican')
@@ -0,0 +1 @@
+../instrument.py
\ No newline at end of file
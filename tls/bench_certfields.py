@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+import os, sys, shutil, tempfile, subprocess, time, hashlib, argparse
+
+from pyasn1_modules import pem, rfc2459
+from pyasn1.codec.der import decoder, encoder
+
+import certfields
+
+def pyasn1_parse_certificate(certificate_path):
+    "Reference implementation, decoding the certificate against the full rfc2459 schema"
+    fqdns = set()
+
+    substrate = pem.readPemFromFile(open(certificate_path))
+    cert = decoder.decode(substrate, asn1Spec=rfc2459.Certificate())[0]
+    core = cert['tbsCertificate']
+
+    der = encoder.encode(core.getComponentByName('subjectPublicKeyInfo'))
+
+    for rdnss in core['subject']:
+        for rdns in rdnss:
+            for name in rdns:
+                if name.getComponentByName('type') == rfc2459.id_at_commonName:
+                    value = decoder.decode(name.getComponentByName('value'), asn1Spec=rfc2459.DirectoryString())[0]
+                    fqdns.add(str(value.getComponent()))
+
+    expiration_date = core['validity'].getComponentByName('notAfter').getComponent().asDateTime.replace(tzinfo=None)
+
+    for extension in core['extensions']:
+        if extension['extnID'] == rfc2459.id_ce_subjectAltName:
+            (san_list, r) = decoder.decode(extension.getComponentByName('extnValue'), rfc2459.SubjectAltName())
+            for san_struct in san_list:
+                if san_struct.getName() == 'dNSName':
+                    fqdns.add(str(san_struct.getComponent()))
+    return (der, expiration_date, fqdns)
+
+def generate_certificates(directory, count, keytype):
+    "Self-signs count certificates with a single key and a few subjectAltNames each"
+    key_path = os.path.join(directory, 'bench.key')
+    if keytype == 'ecdsa':
+        subprocess.check_call(['openssl', 'ecparam', '-genkey', '-name', 'secp384r1', '-out', key_path])
+    else:
+        subprocess.check_call(['openssl', 'genrsa', '-out', key_path, '2048'], stderr=subprocess.DEVNULL)
+
+    paths = []
+    for i in range(count):
+        cn = 'site{}.example.org'.format(i)
+        path = os.path.join(directory, '{:05d}_cert.crt'.format(i))
+        subprocess.check_call(['openssl', 'req', '-new', '-x509', '-key', key_path, '-days', str(1 + i % 365),
+                '-subj', '/CN={}'.format(cn), '-addext', 'subjectAltName=DNS:{0},DNS:www.{0},DNS:mail.{0}'.format(cn),
+                '-out', path])
+        paths.append(path)
+    return paths
+
+def measure(parse, paths, rounds):
+    start = time.perf_counter()
+    for i in range(rounds):
+        results = [parse(path) for path in paths]
+    return (time.perf_counter() - start, results)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare the certfields DER walker with pyasn1 decoding')
+    parser.add_argument('-n', '--count', type=int, default=1000, help='number of certificates (default: 1000)')
+    parser.add_argument('-r', '--rounds', type=int, default=3, help='parses of every certificate (default: 3)')
+    parser.add_argument('-k', '--keytype', default='ecdsa', help='rsa or ecdsa (default: ecdsa)')
+    parser.add_argument('-d', '--directory', default=None,
+            help='parse the *.crt files of this directory instead of generating certificates')
+    args = parser.parse_args()
+
+    workdir = None
+    if args.directory:
+        paths = sorted(os.path.join(args.directory, name) for name in os.listdir(args.directory)
+                if name.endswith('.crt'))
+    else:
+        workdir = tempfile.mkdtemp(prefix='bench_certfields.')
+        paths = generate_certificates(workdir, args.count, args.keytype)
+
+    try:
+        parsed = len(paths) * args.rounds
+        (pyasn1_time, expected) = measure(pyasn1_parse_certificate, paths, args.rounds)
+        (certfields_time, results) = measure(certfields.parse_certificate, paths, args.rounds)
+
+        for (path, (spki, expiration_date, fqdns), (ref_spki, ref_expiration_date, ref_fqdns)) in \
+                zip(paths, results, expected):
+            if (hashlib.sha256(spki).digest(), expiration_date, fqdns) != \
+                    (hashlib.sha256(ref_spki).digest(), ref_expiration_date, ref_fqdns):
+                print('Mismatch on', path, file=sys.stderr)
+                sys.exit(1)
+
+        print('pyasn1:     {:.3f}s, {:.0f} certificates/s'.format(pyasn1_time, parsed / pyasn1_time))
+        print('certfields: {:.3f}s, {:.0f} certificates/s'.format(certfields_time, parsed / certfields_time))
+        print('speedup:    {:.1f}x'.format(pyasn1_time / certfields_time))
+    finally:
+        if workdir:
+            shutil.rmtree(workdir)
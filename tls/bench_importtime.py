@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+import os, sys, subprocess, argparse, statistics
+
+SCRIPTS = ('renew_letsencrypt', 'create_tlsa')
+BUDGET = 30     # milliseconds
+
+def import_times(module, directory):
+    "Cumulative import times in microseconds of module and of everything it imports, as reported by -X importtime"
+    # Cron runs with cached bytecode, compiling the scripts on every import would dwarf their import time
+    env = dict(os.environ)
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    output = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import {}'.format(module)],
+            cwd=directory, env=env, stderr=subprocess.PIPE, universal_newlines=True, check=True).stderr
+    times = {}
+    for line in output.splitlines()[1:]:
+        fields = [field.strip() for field in line.split('|')]
+        if len(fields) == 3:
+            times[fields[2]] = int(fields[1])
+    return times
+
+def heaviest_imports(times, module, count):
+    return sorted(((cumulative, name) for (name, cumulative) in times.items() if name != module), reverse=True)[:count]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check the import time of the tls cron scripts against a budget')
+    parser.add_argument('-b', '--budget', type=float, default=BUDGET,
+            help='maximum median import time per script in ms (default: {})'.format(BUDGET))
+    parser.add_argument('-r', '--runs', type=int, default=5, help='imports per script (default: 5)')
+    parser.add_argument('-v', '--verbose', action='store_true', help='show the heaviest imports')
+    args = parser.parse_args()
+
+    directory = os.path.dirname(os.path.abspath(__file__))
+    over_budget = False
+    for module in SCRIPTS:
+        # The first import writes the bytecode cache
+        import_times(module, directory)
+        runs = [import_times(module, directory) for i in range(args.runs)]
+        median = statistics.median(times[module] for times in runs) / 1000
+        status = 'ok' if median <= args.budget else 'OVER BUDGET'
+        over_budget = over_budget or median > args.budget
+        print('{}: {:.1f}ms (budget {:.1f}ms) {}'.format(module, median, args.budget, status))
+        if args.verbose:
+            for (cumulative, name) in heaviest_imports(runs[-1], module, 5):
+                print('    {:.1f}ms {}'.format(cumulative / 1000, name))
+    sys.exit(1 if over_budget else 0)
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+import re, mmap, base64
+from datetime import datetime
+
+RE_PEM_CERTIFICATE = re.compile(rb'-----BEGIN CERTIFICATE-----(.+?)-----END CERTIFICATE-----', re.DOTALL)
+
+TAG_BOOLEAN = 0x01
+TAG_OCTET_STRING = 0x04
+TAG_OID = 0x06
+TAG_SEQUENCE = 0x30
+TAG_UTC_TIME = 0x17
+TAG_GENERALIZED_TIME = 0x18
+TAG_VERSION = 0xa0
+TAG_EXTENSIONS = 0xa3
+TAG_DNS_NAME = 0x82
+
+OID_COMMON_NAME = bytes((0x55, 0x04, 0x03))
+OID_SUBJECT_ALT_NAME = bytes((0x55, 0x1d, 0x11))
+
+STRING_ENCODINGS = {
+        0x0c: 'utf-8',      # UTF8String
+        0x13: 'ascii',      # PrintableString
+        0x14: 'latin-1',    # TeletexString
+        0x16: 'ascii',      # IA5String
+        0x1c: 'utf-32-be',  # UniversalString
+        0x1e: 'utf-16-be',  # BMPString
+        }
+
+def read_tlv(data, offset):
+    "Returns tag, start and end of the value of the DER element at offset"
+    tag = data[offset]
+    length = data[offset + 1]
+    offset += 2
+    if length & 0x80:
+        size = length & 0x7f
+        length = int.from_bytes(data[offset:offset + size], 'big')
+        offset += size
+    if offset + length > len(data):
+        raise ValueError('truncated DER element')
+    return (tag, offset, offset + length)
+
+def children(data, start, end):
+    "Yields tag, start and end of the value of the DER elements between start and end"
+    while start < end:
+        (tag, value_start, value_end) = read_tlv(data, start)
+        yield (tag, value_start, value_end)
+        start = value_end
+
+def parse_time(tag, value):
+    value = value.decode('ascii').rstrip('Z')
+    if tag == TAG_UTC_TIME:
+        # Two-digit years, 50 and above are in the 20th century
+        year = int(value[:2])
+        value = str(1900 + year if year >= 50 else 2000 + year) + value[2:]
+    return datetime.strptime(value[:14], '%Y%m%d%H%M%S')
+
+def common_names(data, start, end):
+    for (set_tag, set_start, set_end) in children(data, start, end):
+        for (seq_tag, seq_start, seq_end) in children(data, set_start, set_end):
+            ((oid_tag, oid_start, oid_end), (value_tag, value_start, value_end)) = \
+                    list(children(data, seq_start, seq_end))[:2]
+            if data[oid_start:oid_end] == OID_COMMON_NAME and value_tag in STRING_ENCODINGS:
+                yield data[value_start:value_end].decode(STRING_ENCODINGS[value_tag])
+
+def dns_names(data, start, end):
+    "Yields the dNSName entries of the extensions between start and end"
+    for (ext_tag, ext_start, ext_end) in children(data, start, end):
+        fields = list(children(data, ext_start, ext_end))
+        (oid_tag, oid_start, oid_end) = fields[0]
+        if data[oid_start:oid_end] != OID_SUBJECT_ALT_NAME:
+            continue
+        (value_tag, value_start, value_end) = fields[-1]
+        (san_tag, san_start, san_end) = read_tlv(data, value_start)
+        for (name_tag, name_start, name_end) in children(data, san_start, san_end):
+            if name_tag == TAG_DNS_NAME:
+                yield data[name_start:name_end].decode('ascii')
+
+def certificate_fields(der):
+    """Walks a DER certificate without decoding it as a whole.
+    Returns the DER encoding of its subjectPublicKeyInfo, its notAfter date and the fqdns
+    of its subject CommonName and subjectAltName extension."""
+    (tag, start, end) = read_tlv(der, 0)
+    (tag, start, end) = read_tlv(der, start)    # tbsCertificate
+    fields = list(children(der, start, end))
+    if fields[0][0] == TAG_VERSION:
+        fields = fields[1:]
+    # serialNumber, signature, issuer, validity, subject, subjectPublicKeyInfo, then optional fields
+    (validity, subject, spki) = fields[3:6]
+
+    (not_before, not_after) = list(children(der, validity[1], validity[2]))
+    expiration_date = parse_time(not_after[0], der[not_after[1]:not_after[2]])
+
+    fqdns = set(common_names(der, subject[1], subject[2]))
+    for (tag, start, end) in fields[6:]:
+        if tag == TAG_EXTENSIONS:
+            (tag, start, end) = read_tlv(der, start)
+            fqdns.update(dns_names(der, start, end))
+
+    # subjectPublicKeyInfo, header included, starts where subject ends
+    return (der[subject[2]:spki[2]], expiration_date, fqdns)
+
+def certificate_names(der):
+    "Returns the DER encodings of the issuer and subject names of a certificate, headers included"
+    (tag, start, end) = read_tlv(der, 0)
+    (tag, start, end) = read_tlv(der, start)    # tbsCertificate
+    fields = list(children(der, start, end))
+    if fields[0][0] == TAG_VERSION:
+        fields = fields[1:]
+    # Names start where the previous field ends
+    (signature, issuer, validity, subject) = fields[1:5]
+    return (der[signature[2]:issuer[2]], der[validity[2]:subject[2]])
+
+def split_certificates(data):
+    "Returns the DER certificates of a PEM bundle, or data itself if it already is DER"
+    if data[:1] == bytes((TAG_SEQUENCE,)):
+        return [data]
+    return [base64.b64decode(b''.join(match.group(1).split())) for match in RE_PEM_CERTIFICATE.finditer(data)]
+
+def read_certificates(certificate_path):
+    "Returns the DER certificates of a PEM bundle or DER file, read through a memory map"
+    with open(certificate_path, 'rb') as fh:
+        with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            return [bytes(der) for der in split_certificates(data)]
+
+def parse_certificate(certificate_path):
+    "Fields of the first certificate of a file, see certificate_fields()"
+    return certificate_fields(read_certificates(certificate_path)[0])
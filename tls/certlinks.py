@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+import os, subprocess
+
+import certfields
+
+# (certbot output, link) pairs, outputs are numbered by serial
+LATEST_LINKS = (
+        ('{:04d}_cert.crt', 'latest_cert.crt'),
+        ('{:04d}_chain.pem', 'latest_chain.pem'),
+        ('{:04d}_fullchain.pem', 'latest_fullchain.pem'),
+        )
+
+def find_private_key(working_dir, cn):
+    "Path of the private key setup_letsencrypt.py created for cn, or None"
+    for filename in sorted(os.listdir(working_dir)):
+        if filename.startswith(cn + '-') and filename.endswith('.key'):
+            return os.path.join(working_dir, filename)
+    return None
+
+def public_key(key_path):
+    "DER encoding of the subjectPublicKeyInfo of a private key"
+    return subprocess.run(['openssl', 'pkey', '-in', key_path, '-pubout', '-outform', 'DER'],
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True).stdout
+
+def verify_certificate(cert_path, chain_path, fullchain_path, key_path = None):
+    "Raises ValueError unless the certificate, its chain, its full chain and its private key belong together"
+    cert = certfields.read_certificates(cert_path)
+    if len(cert) != 1:
+        raise ValueError('{} holds {} certificates'.format(cert_path, len(cert)))
+    # certbot writes the chain along with the full chain, which is checked against it
+    if fullchain_path and not chain_path:
+        raise ValueError('{} comes without its chain'.format(fullchain_path))
+    if chain_path:
+        chain = certfields.read_certificates(chain_path)
+        if not chain:
+            raise ValueError('{} holds no certificate'.format(chain_path))
+        if certfields.certificate_names(cert[0])[0] != certfields.certificate_names(chain[0])[1]:
+            raise ValueError('{} is not issued by the first certificate of {}'.format(cert_path, chain_path))
+        if fullchain_path and certfields.read_certificates(fullchain_path) != cert + chain:
+            raise ValueError('{} is not {} followed by {}'.format(fullchain_path, cert_path, chain_path))
+    if key_path:
+        (spki, expiration_date, fqdns) = certfields.certificate_fields(cert[0])
+        try:
+            key = public_key(key_path)
+        except subprocess.CalledProcessError:
+            raise ValueError('cannot read private key {}'.format(key_path))
+        if key != spki:
+            raise ValueError('{} does not match private key {}'.format(cert_path, key_path))
+
+def publish_certificate(working_dir, serial, key_path = None):
+    """Verifies the certbot outputs numbered serial, then points the latest_* links of working_dir to them.
+    Each link is swapped atomically with os.replace, so that it always resolves. The caller syncs working_dir,
+    see sync_directories()."""
+    paths = [os.path.join(working_dir, new.format(serial)) for (new, symlink) in LATEST_LINKS]
+    (cert_path, chain_path, fullchain_path) = [path if os.path.exists(path) else None for path in paths]
+    if cert_path is None:
+        raise ValueError('{} does not exist'.format(paths[0]))
+    verify_certificate(cert_path, chain_path, fullchain_path, key_path)
+
+    # Links are relative to working_dir, targets are given relative to the links
+    for ((new, symlink), path) in zip(LATEST_LINKS, (cert_path, chain_path, fullchain_path)):
+        if path is None:
+            continue
+        temp_symlink = os.path.join(working_dir, '.{}.tmp'.format(symlink))
+        if os.path.lexists(temp_symlink):
+            os.remove(temp_symlink)
+        os.symlink(new.format(serial), temp_symlink)
+        os.replace(temp_symlink, os.path.join(working_dir, symlink))
+
+def sync_directories(paths):
+    "Makes link swaps durable, each directory is synced once however many links changed in it"
+    for path in sorted(set(paths)):
+        fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
@@ -1,52 +1,154 @@
 #!/usr/bin/env python3
 # -*- coding: UTF-8 -*-
 
-import os, sys, hashlib, argparse
+import os, sys, hashlib, argparse, re
 
-from pyasn1_modules import pem, rfc2459
-from pyasn1.codec.der import decoder, encoder
-from pyasn1.type.univ import OctetString
+import certfields
+import instrument
 
-def parse_certificate(certificate_path):
-    fqdns = set()
+FORMAT_RECORD = '_{}._{}.{}   IN  TLSA    3 1 1 {}'
+FORMAT_NSUPDATE_ADD = 'update add _{}._{}.{}. {} IN TLSA 3 1 1 {}'
+FORMAT_NSUPDATE_DELETE = 'update delete _{}._{}.{}. IN TLSA 3 1 1 {}'
+RE_RECORD = re.compile(r'^_(\d+)\._(\w+)\.(\S+)\s+IN\s+TLSA\s+3 1 1 ([0-9a-f]+)$')
 
-    substrate = pem.readPemFromFile(open(certificate_path))
-    cert = decoder.decode(substrate, asn1Spec=rfc2459.Certificate())[0]
-    core = cert['tbsCertificate']
+def parse_certificate(certificate_path):
+    (spki, expiration_date, fqdns) = certfields.parse_certificate(certificate_path)
 
     # Hash public key
-    der = encoder.encode(core.getComponentByName('subjectPublicKeyInfo'))
     hash_der = hashlib.sha256()
-    hash_der.update(der)
+    hash_der.update(spki)
     pkhash = hash_der.hexdigest()
-
-    # Extract CommonName
-    for rdnss in core['subject']:
-        for rdns in rdnss:
-            for name in rdns:
-                if name.getComponentByName('type') == rfc2459.id_at_commonName:
-                    value = decoder.decode(name.getComponentByName('value'), asn1Spec=rfc2459.DirectoryString())[0]
-                    fqdns.add(str(value.getComponent()))
-
-    # Extract SubjectAltName
-    for extension in core['extensions']:
-        if extension['extnID'] == rfc2459.id_ce_subjectAltName:
-            octet_string = decoder.decode(extension.getComponentByName('extnValue'), asn1Spec=OctetString())[0]
-            (san_list, r) = decoder.decode(octet_string, rfc2459.SubjectAltName())
-            for san_struct in san_list:
-                if san_struct.getName() == 'dNSName':
-                    fqdns.add(str(san_struct.getComponent()))
     return (pkhash, fqdns)
 
 def create_tlsa(certificate_path, stream, port):
-    (pkhash, fqdns) = parse_certificate(certificate_path)
+    with instrument.span('parse'):
+        (pkhash, fqdns) = parse_certificate(certificate_path)
+    instrument.count('certificates')
+    instrument.count('records', len(fqdns))
     for fqdn in fqdns:
-        print('_{}._{}.{}   IN  TLSA    3 1 1 {}'.format(port, stream, fqdn, pkhash))
+        print(FORMAT_RECORD.format(port, stream, fqdn, pkhash))
+
+def scan_certs_root(certs_root):
+    "Returns the latest certificate of every site, laid out as renew_letsencrypt.py expects"
+    cert_paths = []
+    for site in os.listdir(certs_root):
+        cert_path = os.path.join(certs_root, site, 'latest_cert.crt')
+        if os.path.exists(cert_path):
+            cert_paths.append(cert_path)
+    return cert_paths
+
+def read_manifest(manifest_path):
+    "Returns the certificate paths listed in a file, one per line"
+    with open(manifest_path) as fh:
+        return [line.strip() for line in fh if line.strip() and not line.startswith('#')]
+
+def read_records(zone_path):
+    "Returns the (port, stream, fqdn, pkhash) records of a zone fragment written by this script"
+    records = set()
+    with open(zone_path) as fh:
+        for line in fh:
+            match = RE_RECORD.match(line.strip())
+            if match:
+                records.add(match.groups())
+    return records
+
+def bulk_records(cert_paths, services, jobs = 1):
+    "Returns the records of every certificate for every (port, stream) service"
+    # Sites sharing a certificate file are only parsed once
+    targets = sorted(set(os.path.realpath(cert_path) for cert_path in cert_paths))
+    with instrument.span('parse'):
+        if jobs > 1:
+            from concurrent.futures import ProcessPoolExecutor
+            with ProcessPoolExecutor(max_workers=jobs) as pool:
+                certificates = list(pool.map(parse_certificate, targets))
+        else:
+            certificates = list(map(parse_certificate, targets))
+    instrument.count('certificates', len(targets))
+
+    # Keys shared across certificates give the same records
+    records = set()
+    for (pkhash, fqdns) in certificates:
+        for fqdn in fqdns:
+            for (port, stream) in services:
+                records.add((port, stream, fqdn, pkhash))
+    instrument.count('records', len(records))
+    return records
+
+def sort_key(record):
+    (port, stream, fqdn, pkhash) = record
+    return (fqdn, stream, int(port), pkhash)
+
+def print_zone(records, fh = None):
+    for record in sorted(records, key=sort_key):
+        print(FORMAT_RECORD.format(*record), file=fh)
+
+def write_zone(zone_path, records):
+    "Writes the zone fragment of records, which read_records() reads back as the previous records of the next run"
+    # A run interrupted while writing leaves the previous fragment in place
+    temp_path = '{}.{}.tmp'.format(zone_path, os.getpid())
+    with open(temp_path, 'w') as fh:
+        print_zone(records, fh)
+    os.replace(temp_path, zone_path)
+
+def print_nsupdate(records, previous, ttl):
+    "Prints an nsupdate batch turning the previous records into the new ones, unchanged records are left alone"
+    for record in sorted(previous - records, key=sort_key):
+        print(FORMAT_NSUPDATE_DELETE.format(*record))
+    for (port, stream, fqdn, pkhash) in sorted(records - previous, key=sort_key):
+        print(FORMAT_NSUPDATE_ADD.format(port, stream, fqdn, ttl, pkhash))
+    print('send')
+
+def parse_service(service):
+    (port, stream) = service.split('/')
+    return (port, stream)
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
-    parser.add_argument('certificate', help='path to certificate')
-    parser.add_argument('stream', default='tcp', help='stream type (eg: tcp, udp), default to tcp')
-    parser.add_argument('port', default='443', help='network port, default to 443')
+    parser.add_argument('certificate', nargs='?', help='path to certificate')
+    parser.add_argument('stream', nargs='?', default='tcp', help='stream type (eg: tcp, udp), default to tcp')
+    parser.add_argument('port', nargs='?', default='443', help='network port, default to 443')
+    parser.add_argument('-r', '--certs-root', default=None,
+            help='bulk mode, generate records for the latest certificate of every site of this directory')
+    parser.add_argument('-m', '--manifest', default=None,
+            help='bulk mode, generate records for the certificates listed in this file, one path per line')
+    parser.add_argument('-S', '--service', action='append', type=parse_service, default=None,
+            help='PORT/STREAM covered by bulk records, may be repeated (default: 443/tcp)')
+    parser.add_argument('-f', '--format', choices=('zone', 'nsupdate'), default='zone',
+            help='bulk output, a sorted zone fragment or an nsupdate batch (default: zone)')
+    parser.add_argument('-p', '--previous', default=None,
+            help='zone fragment of the previous bulk run, unchanged records are left out of nsupdate batches')
+    parser.add_argument('-w', '--write-zone', default=None,
+            help='also write the zone fragment of the records to this file, to be given as --previous next time')
+    parser.add_argument('-t', '--ttl', type=int, default=3600, help='TTL of nsupdate records (default: 3600)')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='number of certificates parsed concurrently')
+    parser.add_argument('-M', '--metrics', default=None,
+            help='append run metrics to this JSON lines file, or write them to a Prometheus textfile if it ends in .prom')
     args = parser.parse_args()
-    create_tlsa(args.certificate, args.stream, args.port)
+
+    if args.previous and args.format != 'nsupdate':
+        parser.error('--previous only applies to nsupdate batches')
+    if args.certs_root or args.manifest:
+        cert_paths = []
+        with instrument.span('scan'):
+            if args.certs_root:
+                cert_paths.extend(scan_certs_root(args.certs_root))
+            if args.manifest:
+                cert_paths.extend(read_manifest(args.manifest))
+        records = bulk_records(cert_paths, args.service or [('443', 'tcp')], args.jobs)
+
+        with instrument.span('output'):
+            if args.format == 'zone':
+                print_zone(records)
+            else:
+                previous = read_records(args.previous) if args.previous and os.path.exists(args.previous) else set()
+                print_nsupdate(records, previous, args.ttl)
+            if args.write_zone:
+                write_zone(args.write_zone, records)
+    elif args.write_zone:
+        parser.error('--write-zone requires --certs-root or --manifest')
+    elif args.certificate:
+        create_tlsa(args.certificate, args.stream, args.port)
+    else:
+        parser.error('a certificate, --certs-root or --manifest is required')
+    if args.metrics:
+        instrument.export(args.metrics, 'create_tlsa')
@@ -1,54 +1,51 @@
 #!/usr/bin/env python3
 # -*- coding: UTF-8 -*-
 
-import os, sys, pwd, subprocess, re, argparse
-from datetime import datetime
+import os, sys, pwd, re, time, argparse, sqlite3, json
+from datetime import datetime, timedelta
 
-from pyasn1_modules import pem, rfc2459
-from pyasn1.codec.der import decoder
-from pyasn1.type.univ import OctetString
+import instrument
 
-import yaml
+# Heavier modules (yaml, subprocess, concurrent.futures, certfields, certlinks) are imported where needed,
+# so that a run with nothing to renew is mostly stat calls
 
 CONF_FILE = '/etc/letsencrypt/renew.yaml'
+INDEX_FILE = '/var/cache/letsencrypt/renew.db'
+CONFIG_CACHE = '/var/cache/letsencrypt/renew.json'
 RE_CERTIFICATE_FILENAME = re.compile(r'^(\d+)_cert.crt$')
 
+def load_config(config_path, cache_path = CONFIG_CACHE):
+    "Parses the YAML config, or reuses its JSON copy if the config did not change since it was cached"
+    st = os.stat(config_path)
+    key = [os.path.abspath(config_path), st.st_size, st.st_mtime_ns]
+    try:
+        with open(cache_path) as fh:
+            cache = json.load(fh)
+        if cache['key'] == key:
+            return cache['config']
+    except (OSError, ValueError, KeyError):
+        pass
+
+    import yaml
+    with open(config_path) as fh:
+        config = yaml.safe_load(fh)
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        with open(cache_path, 'w') as fh:
+            json.dump({'key': key, 'config': config}, fh)
+    except OSError:
+        pass
+    return config
+
 def parse_certificate(certificate_path):
-    fqdns = set()
-
-    substrate = pem.readPemFromFile(open(certificate_path))
-    cert = decoder.decode(substrate, asn1Spec=rfc2459.Certificate())[0]
-    core = cert['tbsCertificate']
-
-    # Extract CommonName
-    for rdnss in core['subject']:
-        for rdns in rdnss:
-            for name in rdns:
-                if name.getComponentByName('type') == rfc2459.id_at_commonName:
-                    value = decoder.decode(name.getComponentByName('value'), asn1Spec=rfc2459.DirectoryString())[0]
-                    fqdns.add(str(value.getComponent()))
-
-    # extract notAfter datetime
-    notAfter = str(core['validity'].getComponentByName('notAfter').getComponent()).strip('Z')
-    (year, month, day, hour, minute, seconds) = [int(notAfter[i:i+2]) for i in range(0, len(notAfter), 2)]
-    expiration_date = datetime(2000 + year, month, day, hour, minute, seconds)
-
-    # Extract SubjectAltName
-    for extension in core['extensions']:
-        if extension['extnID'] == rfc2459.id_ce_subjectAltName:
-            (san_list, r) = decoder.decode(extension.getComponentByName('extnValue'), rfc2459.SubjectAltName())
-            for san_struct in san_list:
-                if san_struct.getName() == 'dNSName':
-                    fqdns.add(str(san_struct.getComponent()))
+    import certfields
+    (spki, expiration_date, fqdns) = certfields.parse_certificate(certificate_path)
     return (fqdns, expiration_date)
 
 def renew_certificate(cn, webroot, fqdns, working_dir, admin_email, staging = False, verbose = False):
     cert_symlink = 'latest_cert.crt'
-    chain_symlink = 'latest_chain.pem'
-    fullchain_symlink = 'latest_fullchain.pem'
 
-    os.chdir(working_dir)
-    latest = os.readlink(cert_symlink)
+    latest = os.readlink(os.path.join(working_dir, cert_symlink))
     serial = int(RE_CERTIFICATE_FILENAME.match(latest).group(1))
 
     new_cert = '{:04d}_cert.crt'.format(serial + 1)
@@ -68,60 +65,172 @@ def renew_certificate(cn, webroot, fqdns, working_dir, admin_email, staging = Fa
             ])
     if staging:
         command.extend(['--staging', '--break-my-certs'])
+    import subprocess
     if verbose:
         subprocess.call(['echo'] + command)
-    ret_code = subprocess.call(command)
+    ret_code = instrument.call(command)
     if verbose:
         print(ret_code)
 
     if ret_code == 0:
-        if os.path.exists(new_cert):
-            if os.path.exists(cert_symlink):
-                os.remove(cert_symlink)
-            os.symlink(new_cert, cert_symlink)
-        if os.path.exists(new_chain):
-            if os.path.exists(chain_symlink):
-                os.remove(chain_symlink)
-            os.symlink(new_chain, chain_symlink)
-        if os.path.exists(new_fullchain):
-            if os.path.exists(fullchain_symlink):
-                os.remove(fullchain_symlink)
-            os.symlink(new_fullchain, fullchain_symlink)
+        import certlinks
+        certlinks.publish_certificate(working_dir, serial + 1, certlinks.find_private_key(working_dir, cn))
+    return ret_code == 0
+
+def affected_daemons(daemons, sites):
+    "Daemons using one of the renewed sites, daemons without a sites list use every certificate"
+    if not sites:
+        return []
+    return [daemon for daemon in daemons if 'sites' not in daemon or set(daemon['sites']) & set(sites)]
 
 def restart_daemons(daemons, verbose = False):
+    "Reloads daemons with a single systemctl call per action"
+    import subprocess
+    units = {}
     for daemon in daemons:
-        command = ['systemctl', daemon['action'], daemon['name']]
+        units.setdefault(daemon.get('action', 'reload'), []).append(daemon['name'])
+    for (action, names) in units.items():
+        command = ['systemctl', action] + names
         if verbose:
             subprocess.call(['echo'] + command)
-        ret_code = subprocess.call(command)
+        ret_code = instrument.call(command)
         if verbose:
             print(ret_code)
 
-def handle_certificates(cert_root, www_root, threshold, daemons, admin_email, staging = False, verbose = False):
-    will_restart_daemons = False
-    for site in os.listdir(cert_root):
-        if verbose:
-            print('Evaluating', site)
+def load_index(index_path):
+    "Returns the certificates decoded by previous runs, keyed by the target of their latest_cert.crt link"
+    if os.path.dirname(index_path):
+        os.makedirs(os.path.dirname(index_path), exist_ok=True)
+    with sqlite3.connect(index_path) as conn:
+        conn.execute('CREATE TABLE IF NOT EXISTS certificates (target TEXT PRIMARY KEY, site TEXT, '
+                'inode INTEGER, mtime INTEGER, fqdns TEXT, expiration TEXT)')
+        cur = conn.execute('SELECT target, site, inode, mtime, fqdns, expiration FROM certificates')
+        return {row[0]: (row[1], row[2], row[3], set(row[4].split()), datetime.fromisoformat(row[5]))
+                for row in cur}
+
+def save_index(index_path, records, indexed = {}):
+    "Writes the records which differ from those indexed, as returned by load_index()"
+    changed = [(target, record) for (target, record) in records.items() if indexed.get(target) != record]
+    removed = [(target,) for target in indexed if target not in records]
+    if not changed and not removed:
+        return
+    with sqlite3.connect(index_path) as conn:
+        conn.executemany('DELETE FROM certificates WHERE target = ?', removed)
+        conn.executemany('INSERT OR REPLACE INTO certificates VALUES (?, ?, ?, ?, ?, ?)',
+                ((target, site, inode, mtime, ' '.join(sorted(fqdns)), expiration.isoformat())
+                    for (target, (site, inode, mtime, fqdns, expiration)) in changed))
 
-        site_path = os.path.join(cert_root, site)
-        owner = pwd.getpwuid(os.stat(site_path).st_uid).pw_name
-        webroot = os.path.join(www_root, owner, site)
-        cert_path = os.path.join(site_path, 'latest_cert.crt')
+def list_expiring(index_path, days):
+    "Lists the certificates of the index expiring within days"
+    limit = datetime.now() + timedelta(days=days)
+    for (site, inode, mtime, fqdns, expiration) in sorted(load_index(index_path).values(), key=lambda r: r[4]):
+        if expiration <= limit:
+            print(expiration.isoformat(), site, ' '.join(sorted(fqdns)))
 
-        if os.path.exists(cert_path):
-            (fqdns, expiration_date) = parse_certificate(cert_path)
+def renew_site(site, webroot, fqdns, site_path, admin_email, staging = False, verbose = False):
+    "Renews a single site, so that a failure does not prevent other sites from being renewed"
+    try:
+        return renew_certificate(site, webroot, fqdns, site_path, admin_email, staging, verbose)
+    except Exception as e:
+        print('Renewal of', site, 'failed:', e, file=sys.stderr)
+        return False
+
+def schedule_renewals(renewals, batch_size = 0, window = 0):
+    """Groups renewals, most urgent first, into batches of batch_size (a single batch if 0).
+    Returns (delay, batch) pairs, delays spreading the batches evenly across window seconds."""
+    renewals = sorted(renewals, key=lambda renewal: renewal[0])
+    batch_size = batch_size or len(renewals) or 1
+    batches = [renewals[i:i + batch_size] for i in range(0, len(renewals), batch_size)]
+    interval = window / len(batches) if batches else 0
+    return [(i * interval, [renewal for (expiration, renewal) in batch]) for (i, batch) in enumerate(batches)]
+
+def run_renewals(schedule, jobs = 1, verbose = False):
+    "Runs scheduled batches, returns the sites which got a new certificate"
+    renewed = []
+    start = time.monotonic()
+    for (delay, batch) in schedule:
+        wait = start + delay - time.monotonic()
+        if wait > 0:
             if verbose:
-                print(fqdns)
-
-            now = datetime.now()
-            delta = expiration_date - now
-            if now >= expiration_date or delta.days <= threshold:
-                if verbose:
-                    print('Renewing, expired or expires in', delta.days, 'days, less than', threshold)
-                renew_certificate(site, webroot, fqdns, site_path, admin_email, staging, verbose)
-                will_restart_daemons = True
-    if will_restart_daemons:
-        restart_daemons(daemons, verbose)
+                print('Waiting {:.0f}s before renewing'.format(wait), ', '.join(renewal[0] for renewal in batch))
+            time.sleep(wait)
+        if jobs > 1:
+            from concurrent.futures import ThreadPoolExecutor
+            with ThreadPoolExecutor(max_workers=jobs) as pool:
+                results = list(pool.map(lambda renewal: renew_site(*renewal), batch))
+        else:
+            results = [renew_site(*renewal) for renewal in batch]
+        renewed.extend(renewal[0] for (renewal, result) in zip(batch, results) if result)
+    return renewed
+
+def handle_certificates(cert_root, www_root, threshold, daemons, admin_email, staging = False, verbose = False,
+        jobs = 1, index_path = None, batch_size = 0, window = 0):
+    sites = []
+    with instrument.span('scan'):
+        for site in os.listdir(cert_root):
+            if verbose:
+                print('Evaluating', site)
+
+            site_path = os.path.join(cert_root, site)
+            owner = pwd.getpwuid(os.stat(site_path).st_uid).pw_name
+            webroot = os.path.join(www_root, owner, site)
+            cert_path = os.path.join(site_path, 'latest_cert.crt')
+
+            if os.path.exists(cert_path):
+                sites.append((site, site_path, webroot, cert_path))
+
+        # Only decode certificates which changed since they were indexed
+        index = load_index(index_path) if index_path else {}
+        records = {}
+        certificates = {}
+        for (site, site_path, webroot, cert_path) in sites:
+            target = os.path.realpath(cert_path)
+            st = os.stat(target)
+            record = index.get(target)
+            if record is not None and record[1:3] == (st.st_ino, st.st_mtime_ns):
+                certificates[target] = record[3:]
+            records[target] = (site, st.st_ino, st.st_mtime_ns)
+
+    targets = [target for target in records if target not in certificates]
+    with instrument.span('parse'):
+        if jobs > 1 and targets:
+            from concurrent.futures import ProcessPoolExecutor
+            with ProcessPoolExecutor(max_workers=jobs) as pool:
+                certificates.update(zip(targets, pool.map(parse_certificate, targets)))
+        else:
+            certificates.update(zip(targets, map(parse_certificate, targets)))
+    instrument.count('certificates', len(sites))
+    instrument.count('certificates_parsed', len(targets))
+
+    if index_path:
+        with instrument.span('index'):
+            save_index(index_path, {target: record + certificates[target] for (target, record) in records.items()},
+                    index)
+
+    renewals = []
+    now = datetime.now()
+    for (site, site_path, webroot, cert_path) in sites:
+        (fqdns, expiration_date) = certificates[os.path.realpath(cert_path)]
+        if verbose:
+            print(site, fqdns)
+
+        delta = expiration_date - now
+        if now >= expiration_date or delta.days <= threshold:
+            if verbose:
+                print('Renewing', site, 'expired or expires in', delta.days, 'days, less than', threshold)
+            renewals.append((expiration_date, (site, webroot, fqdns, site_path, admin_email, staging, verbose)))
+
+    with instrument.span('renew'):
+        renewed = run_renewals(schedule_renewals(renewals, batch_size, window), jobs, verbose)
+        if renewed:
+            import certlinks
+            certlinks.sync_directories(os.path.join(cert_root, site) for site in renewed)
+    instrument.count('renewals', len(renewals))
+    instrument.count('renewed', len(renewed))
+    daemons = affected_daemons(daemons, renewed)
+    if daemons:
+        with instrument.span('reload'):
+            restart_daemons(daemons, verbose)
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
@@ -130,8 +239,27 @@ if __name__ == '__main__':
             help='issue staging certificates (useful for testing purposes)')
     parser.add_argument('-c', '--config', default=CONF_FILE, 
             help='path to a config file (default: {})'.format(CONF_FILE))
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+            help='number of certificates parsed and renewed concurrently (default: 1)')
+    parser.add_argument('-e', '--expiring', type=int, default=None, metavar='DAYS',
+            help='only list indexed certificates expiring within DAYS')
+    parser.add_argument('-b', '--batch-size', type=int, default=None,
+            help='number of certificates renewed per batch (default: batch_size from config, or all at once)')
+    parser.add_argument('-w', '--window', type=int, default=None, metavar='SECONDS',
+            help='spread renewal batches across SECONDS (default: window from config, or 0)')
+    parser.add_argument('-M', '--metrics', default=None,
+            help='append run metrics to this JSON lines file, or write them to a Prometheus textfile if it ends in .prom')
     args = parser.parse_args()
-    config = yaml.load(open(args.config))
+    config = load_config(args.config)
+    index_path = config.get('index', INDEX_FILE)
 
-    handle_certificates(config['certs_root'], config['www_root'], config['threshold'], config['daemons'], 
-            config['admin_email'], staging=args.staging, verbose=args.verbose)
+    if args.expiring is not None:
+        list_expiring(index_path, args.expiring)
+    else:
+        handle_certificates(config['certs_root'], config['www_root'], config['threshold'], config['daemons'], 
+                config['admin_email'], staging=args.staging, verbose=args.verbose, jobs=args.jobs,
+                index_path=index_path,
+                batch_size=args.batch_size if args.batch_size is not None else config.get('batch_size', 0),
+                window=args.window if args.window is not None else config.get('window', 0))
+    if args.metrics:
+        instrument.export(args.metrics, 'renew_letsencrypt')
@@ -1,10 +1,19 @@
 #!/usr/bin/env python3
 # -*- coding: UTF-8 -*-
 
-import os, sys, pwd, grp, subprocess, argparse, tempfile
+import os, sys, pwd, grp, re, csv, time, subprocess, argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import yaml
+from cryptography import x509
+from cryptography.x509.oid import NameOID
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+
+import certlinks
+import instrument
 
 CONF_FILE = '/etc/letsencrypt/setup.yaml'
+KEYTYPES = ('ecdsa',)
 
 def setup_env(certs_root, cn, owner, verbose = False):
     path = os.path.join(certs_root, cn)
@@ -17,50 +26,43 @@ def setup_env(certs_root, cn, owner, verbose = False):
 def create_private_key(certs_root, cn, keytype = 'ecdsa', verbose = False):
     if keytype == 'ecdsa':
         key_path = os.path.join(certs_root, cn, '{}-secp384r1.key'.format(cn))
-        command = ['openssl', 'ecparam', '-genkey', '-name', 'secp384r1', '-out', key_path]
+        key = ec.generate_private_key(ec.SECP384R1())
     else:
         print('Type de clé inconnu:', keytype, file=sys.stderr)
         sys.exit(1)
 
     if verbose:
-        subprocess.call(['echo'] + command)
-    ret_code = subprocess.call(command)
+        print('Creating', key_path)
+    # Same PEM encoding and 0600 mode as openssl ecparam -genkey
+    with os.fdopen(os.open(key_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600), 'wb') as fh:
+        fh.write(key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.TraditionalOpenSSL,
+            serialization.NoEncryption()))
     return key_path
 
 def create_certificate_request(certs_root, cn, fqdns, key_path, verbose = False):
-    (fh, temp_conf) = tempfile.mkstemp()
+    "Creates the CSR of cn, with its fqdns as SubjectAltName"
     csr_path = os.path.join(certs_root, cn, '{}.csr'.format(cn))
-
-    san = ','.join(['DNS:' + an for an in fqdns])
-    with open('/etc/ssl/openssl.cnf') as openssl_fh:
-        with open(temp_conf, 'w') as tp_fh:
-            tp_fh.write(openssl_fh.read())
-            print("[SAN]\nsubjectAltName={}".format(san), file=tp_fh)
-
-    command = ['openssl', 'req', '-new', '-sha256', '-key', key_path, '-subj', '/CN={}'.format(cn), 
-            '-reqexts', 'SAN', '-config', temp_conf, '-outform', 'PEM', '-out', csr_path
-            ]
+    with open(key_path, 'rb') as fh:
+        key = serialization.load_pem_private_key(fh.read(), password=None)
 
     if verbose:
-        subprocess.call(['echo'] + command)
-    ret_code = subprocess.call(command)
-    os.unlink(temp_conf)
+        print('Creating', csr_path)
+    csr = x509.CertificateSigningRequestBuilder().subject_name(
+            x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, cn)])).add_extension(
+            x509.SubjectAlternativeName([x509.DNSName(an) for an in fqdns]), critical=False).sign(key, hashes.SHA256())
+    with open(csr_path, 'wb') as fh:
+        fh.write(csr.public_bytes(serialization.Encoding.PEM))
     return csr_path
 
 def apply_for_certificate(certs_root, www_root, owner, cn, fqdns, csr_path, admin_email, 
         staging = False, verbose = False):
-    cert_symlink = 'latest_cert.crt'
-    chain_symlink = 'latest_chain.pem'
-    fullchain_symlink = 'latest_fullchain.pem'
-
     new_cert = '0000_cert.crt'
     new_fullchain = '0000_fullchain.pem'
     new_chain = '0000_chain.pem'
 
+    working_dir = os.path.join(certs_root, cn)
     webroot = os.path.join(www_root, owner, cn)
 
-    os.chdir(os.path.join(certs_root, cn))
-
     command = ['certbot', 'certonly', '-n', '-q',
             '--webroot', '-w', webroot, '--agree-tos',
             ]
@@ -68,28 +70,112 @@ def apply_for_certificate(certs_root, www_root, owner, cn, fqdns, csr_path, admi
         command.extend(['-d', fqdn])
     command.extend(['--email', admin_email,
             '--csr', csr_path,
-            '--cert-path', os.path.join(certs_root, cn, new_cert),
-            '--fullchain-path', os.path.join(certs_root, cn, new_fullchain),
-            '--chain-path', os.path.join(certs_root, cn, new_chain),
+            '--cert-path', os.path.join(working_dir, new_cert),
+            '--fullchain-path', os.path.join(working_dir, new_fullchain),
+            '--chain-path', os.path.join(working_dir, new_chain),
             ])
     if staging:
         command.extend(['--staging', '--break-my-certs'])
     if verbose:
         subprocess.call(['echo'] + command)
-    ret_code = subprocess.call(command)
-
-    if ret_code == 0:
-        if os.path.exists(new_cert):
-            os.symlink(new_cert, cert_symlink)
-        if os.path.exists(new_chain):
-            os.symlink(new_chain, chain_symlink)
-        if os.path.exists(new_fullchain):
-            os.symlink(new_fullchain, fullchain_symlink)
+    ret_code = instrument.call(command)
+
+    if ret_code != 0:
+        raise RuntimeError('certbot exited with {}'.format(ret_code))
+    certlinks.publish_certificate(working_dir, 0, certlinks.find_private_key(working_dir, cn))
+    return working_dir
+
+def site_fqdns(cn, altnames):
+    if altnames:
+        return set([cn] + altnames)
+    return [cn]
+
+def read_sites(sites_path):
+    """Returns the (cn, owner, fqdns) of the sites listed in a CSV file with cn, owner and altnames columns,
+    or in a YAML list of mappings with the same keys. Altnames are separated by commas or spaces."""
+    with open(sites_path, newline='') as fh:
+        if sites_path.endswith('.csv'):
+            entries = list(csv.DictReader(fh))
+        else:
+            entries = yaml.safe_load(fh) or []
+
+    sites = []
+    for entry in entries:
+        altnames = entry.get('altnames') or []
+        if isinstance(altnames, str):
+            altnames = [an for an in re.split(r'[\s,]+', altnames) if an]
+        sites.append((entry['cn'], entry['owner'], site_fqdns(entry['cn'], altnames)))
+    return sites
+
+def prepare_site(certs_root, cn, owner, fqdns, keytype, verbose = False):
+    "Creates the directory, private key and CSR of a site, returns the CSR path and the time it took"
+    start = time.perf_counter()
+    with instrument.span('prepare'):
+        setup_env(certs_root, cn, owner, verbose)
+        key_path = create_private_key(certs_root, cn, keytype, verbose)
+        csr_path = create_certificate_request(certs_root, cn, fqdns, key_path, verbose)
+    return (csr_path, time.perf_counter() - start)
+
+def apply_site(certs_root, www_root, owner, cn, fqdns, csr_path, admin_email, staging = False, verbose = False):
+    start = time.perf_counter()
+    with instrument.span('apply'):
+        working_dir = apply_for_certificate(certs_root, www_root, owner, cn, fqdns, csr_path, admin_email,
+                staging, verbose)
+    return (working_dir, time.perf_counter() - start)
+
+def provision_sites(sites, certs_root, www_root, admin_email, keytype = 'ecdsa', staging = False, verbose = False,
+        jobs = 1, acme_jobs = 1):
+    """Sets up every (cn, owner, fqdns) site. Keys and CSRs are created by jobs workers, each site is handed
+    to at most acme_jobs concurrent certbot runs as soon as its CSR is ready.
+    Returns {cn: (error or None, prepare time, apply time)}."""
+    results = {}
+    published = []
+    with ThreadPoolExecutor(max_workers=jobs) as prepare_pool, \
+            ThreadPoolExecutor(max_workers=acme_jobs) as acme_pool:
+        prepared = {prepare_pool.submit(prepare_site, certs_root, cn, owner, fqdns, keytype, verbose):
+                (cn, owner, fqdns) for (cn, owner, fqdns) in sites}
+        applications = {}
+        for future in as_completed(prepared):
+            (cn, owner, fqdns) = prepared[future]
+            try:
+                (csr_path, prepare_time) = future.result()
+            except Exception as e:
+                results[cn] = (str(e) or type(e).__name__, None, None)
+                continue
+            results[cn] = (None, prepare_time, None)
+            applications[acme_pool.submit(apply_site, certs_root, www_root, owner, cn, fqdns, csr_path,
+                admin_email, staging, verbose)] = cn
+
+        for future in as_completed(applications):
+            cn = applications[future]
+            try:
+                (working_dir, apply_time) = future.result()
+            except Exception as e:
+                results[cn] = (str(e) or type(e).__name__, results[cn][1], None)
+                continue
+            results[cn] = (None, results[cn][1], apply_time)
+            published.append(working_dir)
+
+    certlinks.sync_directories(published)
+    instrument.count('sites', len(results))
+    instrument.count('failures', len(results) - len(published))
+    return results
+
+def print_report(results, elapsed):
+    def seconds(timing):
+        return '-' if timing is None else '{:.2f}s'.format(timing)
+
+    for (cn, (error, prepare_time, apply_time)) in sorted(results.items()):
+        print('{}: {} (key and CSR {}, certificate {})'.format(cn, 'failed: ' + error if error else 'ok',
+            seconds(prepare_time), seconds(apply_time)))
+    failures = sum(1 for (error, prepare_time, apply_time) in results.values() if error)
+    print('{} sites, {} succeeded, {} failed in {:.2f}s'.format(len(results), len(results) - failures, failures,
+        elapsed))
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
-    parser.add_argument('cn', help='main FQDN, used as CommonName')
-    parser.add_argument('owner', help='system user affiliated with certificate')
+    parser.add_argument('cn', nargs='?', help='main FQDN, used as CommonName')
+    parser.add_argument('owner', nargs='?', help='system user affiliated with certificate')
     parser.add_argument('-v', '--verbose', action='store_true', help='talk more')
     parser.add_argument('-s', '--staging', action='store_true',
             help='issue staging certificates (useful for testing purposes)')
@@ -99,16 +185,41 @@ if __name__ == '__main__':
             help='aliases for the certificate, used as SubjectAltName')
     parser.add_argument('-c', '--config', default=CONF_FILE,
             help='path to a config file (default: {})'.format(CONF_FILE))
+    parser.add_argument('-b', '--bulk', default=None, metavar='FILE',
+            help='set up every site of a CSV (cn,owner,altnames columns) or YAML list instead of a single one')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+            help='bulk mode, number of keys and CSRs created concurrently (default: number of CPUs)')
+    parser.add_argument('-J', '--acme-jobs', type=int, default=2,
+            help='bulk mode, number of certificates applied for concurrently (default: 2)')
+    parser.add_argument('-M', '--metrics', default=None,
+            help='append run metrics to this JSON lines file, or write them to a Prometheus textfile if it ends in .prom')
     args = parser.parse_args()
-    config = yaml.load(open(args.config))
-
-    if args.altnames:
-        fqdns = set([args.cn] + args.altnames.split(','))
-    else:
-        fqdns = [args.cn]
+    with open(args.config) as fh:
+        config = yaml.safe_load(fh)
+
+    if args.keytype not in KEYTYPES:
+        parser.error('unknown key type: {}'.format(args.keytype))
+
+    if args.bulk:
+        start = time.perf_counter()
+        results = provision_sites(read_sites(args.bulk), config['certs_root'], config['www_root'],
+                config['admin_email'], args.keytype, staging=args.staging, verbose=args.verbose,
+                jobs=args.jobs, acme_jobs=args.acme_jobs)
+        print_report(results, time.perf_counter() - start)
+        if args.metrics:
+            instrument.export(args.metrics, 'setup_letsencrypt')
+        sys.exit(1 if any(error for (error, prepare_time, apply_time) in results.values()) else 0)
+    elif not args.cn or not args.owner:
+        parser.error('cn and owner are required unless --bulk is given')
+
+    fqdns = site_fqdns(args.cn, args.altnames.split(',') if args.altnames else [])
 
     setup_env(config['certs_root'], args.cn, args.owner, args.verbose)
     key_path = create_private_key(config['certs_root'], args.cn, args.keytype, args.verbose)
     csr_path = create_certificate_request(config['certs_root'], args.cn, fqdns, key_path, args.verbose)
-    apply_for_certificate(config['certs_root'], config['www_root'], args.owner, args.cn, fqdns, csr_path, 
-        config['admin_email'], staging=args.staging, verbose=args.verbose)
+    working_dir = apply_for_certificate(config['certs_root'], config['www_root'], args.owner, args.cn, fqdns,
+        csr_path, config['admin_email'], staging=args.staging, verbose=args.verbose)
+    certlinks.sync_directories([working_dir])
+    instrument.count('sites')
+    if args.metrics:
+        instrument.export(args.metrics, 'setup_letsencrypt')